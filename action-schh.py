@@ -1,88 +1,264 @@
 #!/usr/bin/env python3
 """Snips skill action for Harmony Hub"""
+from functools import partial, wraps
 import gettext
 import locale
+import os
+import signal
 from subprocess import Popen, PIPE, STDOUT
+from threading import Thread
 
 from snipskit.hermes.apps import HermesSnipsApp
 from snipskit.config import AppConfig
-from snipskit.hermes.decorators import intent
+from snipskit.hermes.decorators import intent, session_started
+
+from schh.channels import CHANNELS_SLOT, ChannelDirectory
+from schh.core import TIMEOUTS
+from schh.delays import DelayProfiles
+from schh.hubs import HubRouter
+from schh.injection import InjectionTracker
+from schh.metrics import Metrics
+from schh.snapshot import Snapshot
+from schh.jobs import JobRunner
+from schh.scheduler import PRIORITY_BULK, TIMED_OUT
+from schh.startup import BackgroundStarter, StartupTimer
 
 locale.setlocale(locale.LC_ALL, '')
 gettext.bindtextdomain('messages', 'locales')
 gettext = gettext.gettext
 
+# Channel surfing changes the channel this many times, this many seconds apart
+CHANNEL_SURF_COUNT = 40
+CHANNEL_SURF_DELAY = 8
+
+# Sections for Harmony Hubs besides the one in [secret] start with this,
+# followed by the hub's name; the one in [secret] is named DEFAULT_HUB
+HUB_SECTION = "hub "
+DEFAULT_HUB = "default"
+
+def _needs_skill(handler):
+    """Decorates an intent handler that uses the Harmony Hub, so that it
+    waits for the skill to finish starting in the background, but only for
+    so long"""
+    @wraps(handler)
+    def wrapper(self, hermes, intent_message):
+        if not self._wait_for_skill():
+            if self.starter is None or self.starter.is_ready():
+                sentence = gettext("FAILED_CONNECT")
+            else:
+                sentence = gettext("STILL_STARTING")
+            hermes.publish_end_session(intent_message.session_id, sentence)
+            return None
+        return handler(self, hermes, intent_message)
+    return wrapper
+
+def _routed(handler):
+    """Decorates an intent handler, so that with several Harmony Hubs it
+    runs on the thread for the intent's site's hub, and one slow hub
+    doesn't hold up the others"""
+    @wraps(handler)
+    def wrapper(self, hermes, intent_message):
+        self.hubs.dispatch(intent_message.site_id, handler, self, hermes, intent_message)
+    return wrapper
+
+def _measured(handler):
+    """Decorates an intent handler, recording how long it takes, and how
+    long publishing its response takes, when metrics are enabled"""
+    @wraps(handler)
+    def wrapper(self, hermes, intent_message):
+        if not self.metrics.enabled:
+            return handler(self, hermes, intent_message)
+        with self.metrics.timer("schh_intent_seconds", intent=handler.__name__):
+            return handler(self, _TimedHermes(hermes, self.metrics), intent_message)
+    return wrapper
+
+class _TimedHermes:
+    """Passes everything through to hermes, timing publish_end_session"""
+    def __init__(self, hermes, metrics):
+        self.hermes = hermes
+        self.metrics = metrics
+
+    def publish_end_session(self, *args, **kwargs):
+        with self.metrics.timer("schh_intent_phase_seconds", phase="publish"):
+            return self.hermes.publish_end_session(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.hermes, name)
+
 class SCHHActions(HermesSnipsApp):
     skill = False
+    hubs = None
+    jobs = None
+    metrics = None
+    starter = None
+    startup_wait = 0
+    prewarm = False
+    channels = None
 
-    def _send_command(self, hermes, intent_message, which_command, repeat, delay=0.1):
+    def _send_command(self, hermes, intent_message, which_command, repeat, delay=None):
         print("self._send_command: ", which_command, repeat, delay)
-        ret = self.skill.send_command(which_command, repeat, delay)
+        ret = self._get_skill(intent_message).send_command(which_command, repeat, delay)
         if ret == -1:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("FAILED_CONNECT"))
+        elif ret == TIMED_OUT:
+            hermes.publish_end_session(intent_message.session_id,
+                gettext("HUB_TIMEOUT"))
         elif ret == 0:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("COMMAND_NOT_FOUND"))
+        return ret
+
+    def _set_volume(self, hermes, intent_message, level):
+        print("self._set_volume: ", level)
+        ret = self._get_skill(intent_message).set_volume(level)
+        if ret == -1:
+            hermes.publish_end_session(intent_message.session_id,
+                gettext("FAILED_CONNECT"))
+        elif ret == TIMED_OUT:
+            hermes.publish_end_session(intent_message.session_id,
+                gettext("HUB_TIMEOUT"))
+        elif ret == 0:
+            hermes.publish_end_session(intent_message.session_id,
+                gettext("NO_VOLUME_CONTROL"))
+        return ret
+
+    def _get_skill(self, intent_message):
+        """Returns the SmartCommandsHarmonyHub for the intent's site"""
+        return self.skill.for_site(intent_message.site_id)
+
+    def _get_jobs(self, intent_message):
+        """Returns the JobRunner for the intent's site's hub, so a job in
+        one room isn't cancelled by an intent in another"""
+        return self.jobs[self.hubs.name_for_site(intent_message.site_id)]
+
+    def _get_slots(self, intent_message, *names):
+        """Returns a dict of the value of each named slot, or None for any
+        that weren't given"""
+        with self.metrics.timer("schh_intent_phase_seconds", phase="slots"):
+            values = dict.fromkeys(names)
+            if intent_message.slots is not None:
+                for name in names:
+                    slot = getattr(intent_message.slots, name)
+                    if slot:
+                        values[name] = slot[0].slot_value.value.value
+            return values
 
     @intent('franc:harmony_hub_change_channel')
+    @_routed
+    @_measured
+    @_needs_skill
     def change_channel(self, hermes, intent_message):
-        """Handles intent for changing the channel"""
+        """Handles intent for changing the channel, by number or by a name
+        in the channel directory"""
         print("change_channel intent called")
-        channel_slot = None
-        if intent_message.slots is not None:
-            if intent_message.slots.channel_number:
-                channel_slot = str(intent_message.slots.channel_number[0].slot_value.value.value)
+        self._get_jobs(intent_message).cancel()
+        slots = self._get_slots(intent_message, "channel_number", "channel_name")
+        channel_slot = slots["channel_number"]
+        exact = False
 
-        if channel_slot is None:
+        if slots["channel_name"] is not None:
+            channel_slot = self.channels.lookup(slots["channel_name"])
+            if channel_slot is None:
+                hermes.publish_end_session(intent_message.session_id,
+                    gettext("CHANNEL_UNKNOWN").format(channel=slots["channel_name"]))
+                return
+            exact = True
+        elif channel_slot is None:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("NO_CHANNEL_GIVEN"))
             return
 
-        ret = self.skill.change_channel(channel_slot)
+        ret = self._get_skill(intent_message).change_channel(str(channel_slot), exact)
         if ret == -1:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("FAILED_CONNECT"))
+        elif ret == TIMED_OUT:
+            hermes.publish_end_session(intent_message.session_id,
+                gettext("HUB_TIMEOUT"))
         elif ret == 0:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("FAILED_CHANGE_CHANNEL"))
 
     @intent('franc:harmony_hub_volume')
+    @_routed
+    @_measured
+    @_needs_skill
     def change_volume(self, hermes, intent_message):
-        """Handles intent for changing the volume"""
+        """Handles intent for changing the volume, either up, down or mute,
+        or to a given level"""
         print("change_volume intent called")
-        which_command = None
-        repeat = 1
-        if intent_message.slots is not None:
-            if intent_message.slots.updownmute:
-                which_command = intent_message.slots.updownmute[0].slot_value.value.value
-            if intent_message.slots.repeat:
-                repeat = int(float(intent_message.slots.repeat[0].slot_value.value.value))
+        self._get_jobs(intent_message).cancel()
+        slots = self._get_slots(intent_message, "updownmute", "repeat", "volume_level")
+        which_command = slots["updownmute"]
+        repeat = 1 if slots["repeat"] is None else int(float(slots["repeat"]))
 
-        if which_command is None:
+        if slots["volume_level"] is not None:
+            self._set_volume(hermes, intent_message, int(float(slots["volume_level"])))
+        elif which_command is None:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("NO_VOLUME_GIVEN"))
             return
-
-        self._send_command(hermes, intent_message, which_command, repeat)
+        else:
+            self._send_command(hermes, intent_message, which_command, repeat)
         hermes.publish_end_session(intent_message.session_id, "")
 
     @intent('franc:harmony_hub_channel_surf')
+    @_routed
+    @_measured
+    @_needs_skill
     def channel_surf(self, hermes, intent_message):
-        self._send_command(hermes, intent_message, "ChannelUp", 40, 8)
+        """Handles intent for channel surfing; after the first channel
+        change, the rest happen in the background"""
+        print("channel_surf intent called")
+        self._get_jobs(intent_message).cancel()
+        # Send the first one now, so any problem can be reported
+        if self._send_command(hermes, intent_message, "ChannelUp", 1) != 1:
+            return
+
+        self._get_jobs(intent_message).start(gettext("CHANNEL_SURF_JOB"),
+                partial(self._get_skill(intent_message).send_command, "ChannelUp", 1, None,
+                    PRIORITY_BULK),
+                CHANNEL_SURF_COUNT - 1, CHANNEL_SURF_DELAY, CHANNEL_SURF_DELAY)
         hermes.publish_end_session(intent_message.session_id, "")
 
+    @intent('franc:harmony_hub_stop')
+    @_measured
+    def stop(self, hermes, intent_message):
+        """Handles intent for stopping what's running in the background for
+        the site's hub, e.g. channel surfing"""
+        print("stop intent called")
+        if self._get_jobs(intent_message).cancel():
+            sentence = ""
+        else:
+            sentence = gettext("NO_JOB_RUNNING")
+        hermes.publish_end_session(intent_message.session_id, sentence)
+
+    @intent('franc:harmony_hub_job_status')
+    @_measured
+    def job_status(self, hermes, intent_message):
+        """Handles intent for asking what's running in the background for
+        the site's hub"""
+        print("job_status intent called")
+        status = self._get_jobs(intent_message).status()
+        if status is None or status["state"] not in ("queued", "running"):
+            sentence = gettext("NO_JOB_RUNNING")
+        else:
+            sentence = gettext("JOB_STATUS").format(job=status["name"],
+                    done=status["done"], count=status["count"])
+        hermes.publish_end_session(intent_message.session_id, sentence)
+
     @intent('franc:harmony_hub_send_command')
+    @_routed
+    @_measured
+    @_needs_skill
     def send_command(self, hermes, intent_message):
         """Handles intent for sending a command"""
         print("send_command intent called")
-        which_command = None
-        repeat = 1
-        if intent_message.slots is not None:
-            if intent_message.slots.command:
-                which_command = intent_message.slots.command[0].slot_value.value.value
-            if intent_message.slots.repeat:
-                repeat = int(float(intent_message.slots.repeat[0].slot_value.value.value))
+        self._get_jobs(intent_message).cancel()
+        slots = self._get_slots(intent_message, "command", "repeat")
+        which_command = slots["command"]
+        repeat = 1 if slots["repeat"] is None else int(float(slots["repeat"]))
 
         if which_command is None:
             hermes.publish_end_session(intent_message.session_id,
@@ -93,24 +269,27 @@ class SCHHActions(HermesSnipsApp):
         hermes.publish_end_session(intent_message.session_id, "")
 
     @intent('franc:harmony_hub_power_on')
+    @_routed
+    @_measured
+    @_needs_skill
     def power_on(self, hermes, intent_message):
         """Handles intent for power on (starting an activity)"""
         print("power_on intent called")
-        activity = None
-        if intent_message.slots is not None:
-            if intent_message.slots.activity:
-                activity = intent_message.slots.activity[0].slot_value.value.value
+        self._get_jobs(intent_message).cancel()
+        activity = self._get_slots(intent_message, "activity")["activity"]
 
         if activity is None:
             hermes.publish_end_session(intent_message.session_id,
                 gettext("NO_ACTIVITY_GIVEN"))
             return
 
-        ret = self.skill.start_activity(activity)
+        ret = self._get_skill(intent_message).start_activity(activity)
         if ret == 1:
             sentence = gettext("STARTED_ACTIVITY").format(activity=activity)
         elif ret == -1:
             sentence = gettext("FAILED_CONNECT")
+        elif ret == TIMED_OUT:
+            sentence = gettext("HUB_TIMEOUT")
         elif ret == -2:
             sentence = gettext("ACTIVITY_ALREADY_STARTED").format(activity=activity)
         elif ret == -3:
@@ -120,13 +299,18 @@ class SCHHActions(HermesSnipsApp):
         hermes.publish_end_session(intent_message.session_id, sentence)
 
     @intent('franc:harmony_hub_list_activities')
+    @_routed
+    @_measured
+    @_needs_skill
     def list_activities(self, hermes, intent_message):
         """Handles intent for listing activities"""
         print("list_activities intent called")
 
-        activities = self.skill.list_activities()
+        activities = self._get_skill(intent_message).list_activities()
         if isinstance(activities, int) and activities == -1:
             sentence = gettext("FAILED_CONNECT")
+        elif isinstance(activities, int) and activities == TIMED_OUT:
+            sentence = gettext("HUB_TIMEOUT")
         elif len(activities) == 0:
             sentence = gettext("NO_ACTIVITIES_ON_HUB")
         else:
@@ -139,35 +323,205 @@ class SCHHActions(HermesSnipsApp):
         hermes.publish_end_session(intent_message.session_id, sentence)
 
     @intent('franc:harmony_hub_which_activity')
+    @_routed
+    @_measured
+    @_needs_skill
     def which_activity(self, hermes, intent_message):
         """Handles intent for listing which activity is current"""
         print("which_activities intent called")
 
-        ret_value = self.skill.current_activity()
+        ret_value = self._get_skill(intent_message).current_activity()
         if isinstance(ret_value, int) and ret_value == -1:
             sentence = gettext("FAILED_CONNECT")
+        elif isinstance(ret_value, int) and ret_value == TIMED_OUT:
+            sentence = gettext("HUB_TIMEOUT")
         else:
             (activity_id, activity_name) = ret_value
             sentence = gettext("CURRENT_ACTIVITY").format(activity=activity_name)
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @session_started
+    def session_started(self, hermes, session_started_message):
+        """Handles the start of any dialogue session, usually just after
+        the hotword, by getting the connection to the site's Harmony Hub
+        ready while the rest is being recognized"""
+        if self.prewarm and self.skill:
+            self.skill.for_site(session_started_message.site_id).prewarm()
+
     def initialize(self):
         """Initialization; determine which type of connection to use, create the object, and inject activities"""
-        if self.config["secret"]["control"] == "XMPP":
-            from schh.schh import SmartCommandsHarmonyHub
+        self.startup = StartupTimer()
+        self._start_metrics()
+        (self.hub_addresses, sites) = self._get_hubs()
+        self.hubs = HubRouter(self.hub_addresses, sites,
+                self.config["global"].get("default_hub", ""))
+        self.jobs = dict([(name, JobRunner()) for name in self.hubs.names])
+        signal.signal(signal.SIGTERM, self._exit)
+        self.startup_wait = float(self.config["global"].get("startup_wait", "10"))
+        self.prewarm = self.config["global"].get("prewarm", "no") == "yes"
+        if self.config["global"].get("startup", "eager") == "background":
+            # Intents are handled as soon as this returns; any that need the
+            # hub wait in _wait_for_skill until it's ready
+            self.starter = BackgroundStarter(self._start_skill).start()
         else:
-            from schh.schhaio import SmartCommandsHarmonyHub
-        self.skill = SmartCommandsHarmonyHub(self.config["secret"]["remotename"])
-        self.inject_activities()
+            self._start_skill()
+
+    def _start_skill(self):
+        """Loads what's saved, imports the backend, creates an object for
+        each hub, and injects activities; returns the HubRouter"""
+        with self.startup.phase("load"):
+            snapshots = {}
+            delays = {}
+            for name in self.hub_addresses:
+                snapshots[name] = Snapshot(self._get_hub_path("snapshot", name))
+                delays[name] = self._get_delay_profiles(name)
+            # What has been injected is kept with the default hub
+            self.snapshot = snapshots[self.hubs.default]
+            self.injection = InjectionTracker(self.snapshot.injected, self.snapshot.fingerprint)
+            path = self.config["global"].get("channels", "")
+            self.channels = ChannelDirectory(path if path else None)
+        with self.startup.phase("import"):
+            if self.config["secret"]["control"] == "XMPP":
+                from schh.schh import SmartCommandsHarmonyHub
+            else:
+                from schh.schhaio import SmartCommandsHarmonyHub
+        with self.startup.phase("connect"):
+            connection = self.config["global"].get("connection", "persistent")
+            config_ttl = int(self.config["global"].get("config_ttl", "0"))
+            coalesce_window = int(self.config["global"].get("coalesce_ms", "0")) / 1000
+            timeouts = self._get_timeouts()
+            idle_close = int(self.config["global"].get("idle_close", "0"))
+            volume_max = int(self.config["global"].get("volume_max", "50"))
+            for (name, remotename) in self.hub_addresses.items():
+                self.hubs.add(name, SmartCommandsHarmonyHub(remotename, connection,
+                        config_ttl, coalesce_window, delays[name], snapshots[name],
+                        self.metrics, timeouts, idle_close, volume_max))
+            self.hubs.add_config_listener(self._on_config_changed)
+            self.skill = self.hubs
+        with self.startup.phase("inject"):
+            if any([snapshot.config is None for snapshot in snapshots.values()]):
+                self.inject_activities()
+            else:
+                # Answer from the snapshot straight away, and check it
+                # against the hub in the background
+                self.inject_activities(False)
+                Thread(target=self.inject_activities, daemon=True).start()
+        self.startup.finish()
+        return self.hubs
+
+    def _wait_for_skill(self):
+        """Returns True once the skill has started, waiting up to
+        startup_wait seconds for a background start to finish"""
+        if self.skill:
+            return True
+        return self.starter is not None and self.starter.wait(self.startup_wait) is not None
+
+    def _start_metrics(self):
+        """Creates the Metrics described by the config, and starts serving
+        them if a port is given"""
+        self.metrics = Metrics(self.config["global"].get("metrics", "no") == "yes")
+        if not self.metrics.enabled:
+            return
+        port = int(self.config["global"].get("metrics_port", "0"))
+        if port:
+            self.metrics.serve(port)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._dump_metrics)
+
+    def _dump_metrics(self, *_):
+        """Called on SIGUSR1; writes the metrics to metrics_file, or prints
+        them if there isn't one"""
+        path = self.config["global"].get("metrics_file", "")
+        if path:
+            self.metrics.write(path)
+        else:
+            print(self.metrics.export())
+
+    def _exit(self, *_):
+        """Called on SIGTERM, e.g. when the service is stopped; saves what
+        each hub has learned since it was last saved, e.g. delay profiles,
+        and closes the hubs, so the process can exit.  This includes any
+        hubs created so far by a start that hasn't finished"""
+        self.hubs.save()
+        self.hubs.close()
+        raise SystemExit(0)
+
+    def _get_hubs(self):
+        """Returns a dict of name to remotename for each Harmony Hub in the
+        config, and a dict of site ID to the name of the hub for that site"""
+        hubs = {}
+        sites = {}
+        sections = [section for section in self.config.sections()
+                if section.startswith(HUB_SECTION)]
+        if self.config["secret"].get("remotename", "") or not sections:
+            hubs[DEFAULT_HUB] = self.config["secret"]["remotename"]
+        for section in sections:
+            name = section[len(HUB_SECTION):].strip()
+            hubs[name] = self.config[section]["remotename"]
+            for site_id in self.config[section].get("sites", "").split(","):
+                if site_id.strip():
+                    sites[site_id.strip()] = name
+        return (hubs, sites)
+
+    def _get_hub_path(self, option, name):
+        """Returns the file given by option in [global] for the named hub,
+        or None if there isn't one; each hub but the default one has its
+        name added to the file name"""
+        path = self.config["global"].get(option, "")
+        if not path:
+            return None
+        if name == DEFAULT_HUB:
+            return path
+        (root, ext) = os.path.splitext(path)
+        return "{}-{}{}".format(root, name, ext)
+
+    def _get_delay_profiles(self, name):
+        """Creates the DelayProfiles described by the config for the named
+        hub"""
+        configured = {}
+        if "delays" in self.config:
+            for (device, delay) in self.config["delays"].items():
+                configured[device] = float(delay)
+        path = self._get_hub_path("delay_profiles", name)
+        return DelayProfiles(path,
+                float(self.config["global"].get("delay", "0.1")),
+                configured=configured,
+                learn=self.config["global"].get("learn_delays", "no") == "yes")
+
+    def _get_timeouts(self):
+        """Returns the seconds to wait for each operation: the defaults in
+        TIMEOUTS, overridden by the config"""
+        timeouts = dict(TIMEOUTS)
+        if "timeout" in self.config["global"]:
+            timeouts["default"] = float(self.config["global"]["timeout"])
+        if "timeouts" in self.config:
+            for (operation, timeout) in self.config["timeouts"].items():
+                timeouts[operation] = float(timeout)
+        return timeouts
+
+    def _on_config_changed(self, _):
+        """Called when the Harmony Hub's configuration changes; injects
+        anything new on another thread, so the hub isn't held up"""
+        Thread(target=self.inject_activities, daemon=True).start()
 
+    def inject_activities(self, refresh=True):
+        """Injects any activities, commands and channel names the ASR
+        doesn't know yet
 
-    def inject_activities(self):
-        print("Calling self.skill.get_injection_payload")
-        payload = self.skill.get_injection_payload()
-        if not payload:
-            print("Failed to get payload for injection!")
+        refresh: False to use the cached configuration without contacting
+        the hub
+        """
+        print("Calling self.skill.get_vocabulary")
+        vocabulary = self.skill.get_vocabulary(refresh)
+        if vocabulary and self.channels.names:
+            vocabulary = dict(vocabulary)
+            vocabulary[CHANNELS_SLOT] = self.channels.names
+        if not vocabulary:
+            print("Failed to get vocabulary for injection!")
+        elif self.injection.inject(vocabulary, self.hermes.request_injection):
+            self.snapshot.set_injection(self.injection.injected, self.injection.fingerprint)
         else:
-            self.hermes.request_injection(payload)
+            print("Nothing new to inject")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Benchmarks the backends against a simulated Harmony Hub"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+from schh.simulator import SimulatedHub, make_config
+
+# Operations that can be benchmarked, in the order they're run
+OPERATIONS = ["send_command", "change_channel", "start_activity", "get_injection_payload"]
+
+def import_backend(backend):
+    """Returns the SmartCommandsHarmonyHub class for the named backend"""
+    if backend == "xmpp":
+        from schh.schh import SmartCommandsHarmonyHub
+    else:
+        from schh.schhaio import SmartCommandsHarmonyHub
+    return SmartCommandsHarmonyHub
+
+def percentile(samples, fraction):
+    """Returns the given fraction's percentile of sorted samples"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(samples, elapsed, failures):
+    """Returns a dict describing a list of latencies in seconds"""
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "failures": failures,
+        "mean": sum(samples) / len(samples) if samples else None,
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+        "max": samples[-1] if samples else None,
+        "throughput": len(samples) / elapsed if elapsed else None,
+    }
+
+def run_operation(skill, hub, operation, iterations):
+    """Runs operation iterations times; returns a summary of its latency"""
+    activities = [activity["label"] for activity in hub.config["activity"][1:]]
+    samples = []
+    failures = 0
+    began = perf_counter()
+    for idx in range(iterations):
+        if operation == "get_injection_payload":
+            # Make every call download the config and rebuild the index,
+            # as it would after the hub's config changes
+            skill.cache.invalidate()
+        start = perf_counter()
+        if operation == "send_command":
+            result = skill.send_command("Volume Up", 1)
+        elif operation == "change_channel":
+            result = skill.change_channel(str(idx % 1000))
+        elif operation == "start_activity":
+            result = skill.start_activity(activities[(idx + 1) % len(activities)])
+        else:
+            result = skill.get_injection_payload()
+            result = 0 if result is None else 1
+        samples.append(perf_counter() - start)
+        if result != 1:
+            failures += 1
+    return summarize(samples, perf_counter() - began, failures)
+
+def run_backend(backend, args):
+    """Benchmarks one backend; returns a dict of operation to summary"""
+    hub = SimulatedHub(make_config(args.activities, args.devices, args.functions, args.seed),
+            args.latency / 1000, args.jitter / 1000, args.drop, args.seed)
+    smart_commands_harmony_hub = import_backend(backend)
+    hub.install()
+    start = perf_counter()
+    skill = smart_commands_harmony_hub("simulated", args.connection)
+    results = {"startup": perf_counter() - start}
+    # Everything but start_activity needs a current activity
+    skill.start_activity(hub.config["activity"][1]["label"])
+    for operation in args.operations:
+        results[operation] = run_operation(skill, hub, operation, args.iterations)
+    skill.close()
+    results["hub_requests"] = dict(hub.counts)
+    return results
+
+def get_version():
+    """Returns the git description of the code being benchmarked"""
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(backend, results):
+    print("%s backend, startup %.1f ms" % (backend, results["startup"] * 1000))
+    print("  %-22s %6s %5s %9s %9s %9s %9s %9s" % ("operation", "count", "fail",
+            "mean ms", "p50 ms", "p90 ms", "p99 ms", "ops/s"))
+    for operation in OPERATIONS:
+        if operation not in results:
+            continue
+        summary = results[operation]
+        print("  %-22s %6d %5d %9.2f %9.2f %9.2f %9.2f %9.1f" % (operation,
+                summary["count"], summary["failures"], summary["mean"] * 1000,
+                summary["p50"] * 1000, summary["p90"] * 1000, summary["p99"] * 1000,
+                summary["throughput"]))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["aio", "xmpp", "both"], default="both")
+    parser.add_argument("--connection", choices=["persistent", "per_call"], default="persistent")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--activities", type=int, default=20)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--functions", type=int, default=50,
+            help="Functions per device")
+    parser.add_argument("--latency", type=float, default=5,
+            help="Milliseconds each hub request takes")
+    parser.add_argument("--jitter", type=float, default=0,
+            help="Up to this many milliseconds are added to each hub request")
+    parser.add_argument("--drop", type=float, default=0,
+            help="Fraction of hub requests that are dropped")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="File to write the results to")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    backends = ["aio", "xmpp"] if args.backend == "both" else [args.backend]
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "version": get_version(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "backends": {},
+    }
+    for backend in backends:
+        results = run_backend(backend, args)
+        report["backends"][backend] = results
+        print_results(backend, results)
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(report, results_file, indent=1, sort_keys=True)
+    sys.exit(0)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Replays recorded or synthetic intents through the skill's intent handlers"""
+
+import argparse
+import configparser
+import importlib.util
+import json
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, sleep
+
+from schh.simulator import SimulatedHub, make_config
+
+# Intents and slots used for synthetic streams; bursts are all the first
+SYNTHETIC_INTENTS = [
+    ("franc:harmony_hub_volume", {"updownmute": "Mute"}),
+    ("franc:harmony_hub_volume", {"updownmute": "Volume Up", "repeat": 2}),
+    ("franc:harmony_hub_send_command", {"command": "Pause"}),
+    ("franc:harmony_hub_change_channel", {"channel_number": 7}),
+    ("franc:harmony_hub_which_activity", {}),
+    ("franc:harmony_hub_list_activities", {}),
+]
+
+def load_actions(path):
+    """Imports action-schh.py, and returns its SCHHActions class"""
+    spec = importlib.util.spec_from_file_location("action_schh", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.SCHHActions
+
+class _Value:
+    def __init__(self, value):
+        self.value = value
+
+class _Slot:
+    def __init__(self, value):
+        self.slot_value = _Value(_Value(value))
+
+class _Slots:
+    """Slots of an intent message; missing ones are empty, as in
+    hermes_python"""
+    def __init__(self, slots):
+        for (name, value) in slots.items():
+            setattr(self, name, [_Slot(value)])
+
+    def __getattr__(self, name):
+        return []
+
+class IntentMessage:
+    """The parts of hermes_python's IntentMessage the handlers use"""
+    def __init__(self, intent_name, slots, session_id, site_id):
+        self.intent_name = intent_name
+        self.slots = _Slots(slots)
+        self.session_id = session_id
+        self.site_id = site_id
+
+class ReplayHermes:
+    """Stands in for the Hermes object, recording when each session ends"""
+    def __init__(self):
+        self.lock = Lock()
+        self.ended = {}
+        self.injections = 0
+
+    def publish_end_session(self, session_id, text):
+        with self.lock:
+            # Only the first response reaches the user
+            if session_id not in self.ended:
+                self.ended[session_id] = (monotonic(), text)
+
+    def request_injection(self, payload):
+        with self.lock:
+            self.injections += 1
+
+def get_handlers(actions):
+    """Returns a dict of intent name to the handler for it"""
+    handlers = {}
+    for name in dir(type(actions)):
+        method = getattr(type(actions), name)
+        intent_name = getattr(method, "subscribe_intent", None)
+        if intent_name is not None:
+            handlers[intent_name] = getattr(actions, name)
+    return handlers
+
+def load_intents(path):
+    """Reads a JSON-lines file of intents, each with intent, slots,
+    session_id, site_id and time, the seconds after the start it arrives"""
+    intents = []
+    with open(path) as intents_file:
+        for (idx, line) in enumerate(intents_file):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            intents.append({
+                "intent": entry["intent"],
+                "slots": entry.get("slots", {}),
+                "session_id": entry.get("session_id", "replay-%d" % idx),
+                "site_id": entry.get("site_id", "default"),
+                "time": float(entry.get("time", 0)),
+            })
+    intents.sort(key=lambda entry: entry["time"])
+    return intents
+
+def synthesize(path, count, sites, spacing, burst, seed):
+    """Writes a synthetic stream of count intents from the given number of
+    sites; with burst, every site says the same thing at the same time"""
+    rand = random.Random(seed)
+    with open(path, "w") as intents_file:
+        for idx in range(count):
+            if burst:
+                (intent_name, slots) = SYNTHETIC_INTENTS[0]
+                arrival = (idx // sites) * spacing
+            else:
+                (intent_name, slots) = rand.choice(SYNTHETIC_INTENTS)
+                arrival = idx * spacing
+            intents_file.write(json.dumps({
+                "intent": intent_name,
+                "slots": slots,
+                "session_id": "synthetic-%d" % idx,
+                "site_id": "site%d" % (idx % sites),
+                "time": round(arrival, 3),
+            }) + "\n")
+
+def start_actions(args):
+    """Creates the skill's actions without connecting to MQTT, as
+    HermesSnipsApp would, and returns them with the ReplayHermes"""
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if args.simulate:
+        hub = SimulatedHub(make_config(args.activities, args.devices, args.functions),
+                args.latency / 1000, args.jitter / 1000, args.drop)
+        config["secret"]["remotename"] = "simulated"
+        if config["secret"]["control"] == "XMPP":
+            import schh.schh
+        else:
+            import schh.schhaio
+        hub.install()
+        hub.activity_id = int(hub.config["activity"][1]["id"])
+    actions_class = load_actions(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            "action-schh.py"))
+    actions = actions_class.__new__(actions_class)
+    actions.config = config
+    actions.hermes = ReplayHermes()
+    actions.initialize()
+    if actions.starter is not None:
+        actions.starter.wait(None)
+    return actions
+
+def replay(actions, intents, workers):
+    """Feeds intents to their handlers at their arrival times, on the given
+    number of threads; returns a list of (entry, arrived, finished, error)"""
+    handlers = get_handlers(actions)
+    results = []
+    lock = Lock()
+
+    def handle(entry, arrived):
+        error = None
+        handler = handlers.get(entry["intent"])
+        try:
+            if handler is None:
+                error = "unknown intent"
+            else:
+                handler(actions.hermes, IntentMessage(entry["intent"], entry["slots"],
+                        entry["session_id"], entry["site_id"]))
+        except Exception as e:
+            error = repr(e)
+        with lock:
+            results.append((entry, arrived, monotonic(), error))
+
+    began = monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in intents:
+            wait = began + entry["time"] - monotonic()
+            if wait > 0:
+                sleep(wait)
+            executor.submit(handle, entry, began + entry["time"])
+    return results
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def report(results, hermes, deadline):
+    """Returns a dict of end-to-end latency percentiles, and counts of
+    dropped, late and failed intents"""
+    latencies = []
+    dropped = []
+    late = []
+    errors = []
+    for (entry, arrived, finished, error) in results:
+        if error is not None:
+            errors.append((entry["session_id"], error))
+        ended = hermes.ended.get(entry["session_id"])
+        if ended is None:
+            dropped.append(entry["session_id"])
+            continue
+        latency = ended[0] - arrived
+        latencies.append(latency)
+        if latency > deadline:
+            late.append(entry["session_id"])
+    latencies.sort()
+    return {
+        "intents": len(results),
+        "answered": len(latencies),
+        "dropped": len(dropped),
+        "late": len(late),
+        "errors": errors,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("intents", help="JSON-lines file of intents")
+    parser.add_argument("--config", default="config.ini.default")
+    parser.add_argument("--workers", type=int, default=1,
+            help="Intents handled at once; Hermes itself uses one thread")
+    parser.add_argument("--deadline", type=float, default=2,
+            help="Seconds after which a response counts as late")
+    parser.add_argument("--simulate", action="store_true",
+            help="Use a simulated Harmony Hub instead of the configured one")
+    parser.add_argument("--activities", type=int, default=5)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--functions", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=5,
+            help="Milliseconds each simulated hub request takes")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--drop", type=float, default=0)
+    parser.add_argument("--synthesize", type=int, metavar="COUNT",
+            help="Write COUNT synthetic intents to the intents file, and exit")
+    parser.add_argument("--sites", type=int, default=1,
+            help="Satellites the synthetic intents come from")
+    parser.add_argument("--spacing", type=float, default=0.5,
+            help="Seconds between synthetic intents, or bursts")
+    parser.add_argument("--burst", action="store_true",
+            help="Every satellite says \"mute\" at the same time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="File to write the report to")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synthesize:
+        synthesize(args.intents, args.synthesize, args.sites, args.spacing, args.burst, args.seed)
+        sys.exit(0)
+
+    actions = start_actions(args)
+    results = replay(actions, load_intents(args.intents), args.workers)
+    summary = report(results, actions.hermes, args.deadline)
+    actions.skill.close()
+
+    print("intents: %d, answered: %d, dropped: %d, late: %d, errors: %d" % (
+            summary["intents"], summary["answered"], summary["dropped"],
+            summary["late"], len(summary["errors"])))
+    if summary["answered"]:
+        print("end to end ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (
+                summary["p50"] * 1000, summary["p90"] * 1000,
+                summary["p99"] * 1000, summary["max"] * 1000))
+    for (session_id, error) in summary["errors"]:
+        print("  %s: %s" % (session_id, error))
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(summary, report_file, indent=1, sort_keys=True)
+    sys.exit(0)
@@ -0,0 +1,115 @@
+"""Provides CircuitBreaker for failing fast while a Harmony Hub is unreachable"""
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Consecutive failures that open the circuit
+FAILURE_THRESHOLD = 2
+
+# Seconds to wait before each background probe while the circuit is open
+PROBE_DELAYS = [1, 2, 5, 10, 30, 60]
+
+class CircuitBreaker:
+    """Tracks consecutive failures to reach the Harmony Hub.  After
+    FAILURE_THRESHOLD of them the circuit opens, and requests should fail
+    at once instead of waiting out another connection attempt, while probe
+    is called in the background, with backoff, until the hub answers"""
+    def __init__(self, probe, failure_threshold=FAILURE_THRESHOLD, probe_delays=None):
+        """Initialize members
+
+        probe: Function that tries to reach the hub, bypassing the
+        breaker; it returns True on success
+        failure_threshold: Consecutive failures that open the circuit
+        probe_delays: Seconds to wait before each probe; the last one is
+        repeated
+        """
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_delays = probe_delays if probe_delays is not None else PROBE_DELAYS
+        self.lock = Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.last_failure = None
+        self.last_success = None
+        self.next_probe = None
+        self.stopped = Event()
+        self.prober = None
+
+    def allow(self):
+        """Returns True if a request should try to reach the hub"""
+        return self.state == CLOSED
+
+    def record_success(self):
+        """Records that the hub was reached"""
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = None
+            self.next_probe = None
+            self.last_success = time()
+
+    def record_failure(self):
+        """Records that the hub could not be reached"""
+        with self.lock:
+            self.failures += 1
+            self.last_failure = time()
+            if self.state != CLOSED or self.failures < self.failure_threshold:
+                return
+            print("Harmony Hub unreachable; failing fast until it answers again")
+            self.state = OPEN
+            self.opened = time()
+            if self.prober is None or not self.prober.is_alive():
+                self.prober = Thread(target=self._probe_loop, daemon=True)
+                self.prober.start()
+
+    def _probe_loop(self):
+        attempt = 0
+        while self.state != CLOSED:
+            delay = self.probe_delays[min(attempt, len(self.probe_delays) - 1)]
+            self.next_probe = monotonic() + delay
+            if self.stopped.wait(delay):
+                return
+            attempt += 1
+            with self.lock:
+                if self.state == CLOSED:
+                    return
+                self.state = HALF_OPEN
+            try:
+                reached = self.probe()
+            except Exception as e:
+                print("Caught exception while probing Harmony Hub!")
+                print(e)
+                reached = False
+            if reached:
+                self.record_success()
+            else:
+                with self.lock:
+                    self.failures += 1
+                    self.last_failure = time()
+                    self.state = OPEN
+
+    def health(self):
+        """Returns a dict describing the circuit"""
+        with self.lock:
+            next_probe = None
+            if self.next_probe is not None and self.state != CLOSED:
+                next_probe = max(0, self.next_probe - monotonic())
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened": self.opened,
+                "last_failure": self.last_failure,
+                "last_success": self.last_success,
+                "next_probe_in": next_probe,
+            }
+
+    def close(self):
+        """Stops probing"""
+        self.stopped.set()
+
+__all__ = ["CLOSED", "CircuitBreaker", "HALF_OPEN", "OPEN"]
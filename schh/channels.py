@@ -0,0 +1,61 @@
+"""Provides ChannelDirectory for changing to a channel by name"""
+import json
+import os
+import re
+
+# Slot the names of channels are injected into
+CHANNELS_SLOT = "harmony_hub_channel_name"
+
+def normalize_name(name):
+    """Returns the form of a channel name used as a key in the directory:
+    lower case words, without punctuation"""
+    return " ".join(re.sub(r"[^\w\s]", " ", name.lower()).split())
+
+class ChannelDirectory:
+    """Named channels, loaded from a JSON file holding a list of channels,
+    each with a name, optional aliases, a number, and an optional
+    sub-channel for digital channels, e.g.
+        [{"name": "BBC One", "aliases": ["BBC 1"], "number": 101},
+         {"name": "ABC", "number": 7, "sub_channel": 1}]"""
+    def __init__(self, path=None):
+        """Initialize members
+
+        path: File to load the channels from, or None for no channels
+        """
+        self.path = path
+        self.names = []
+        self.channels = {}
+        self.load()
+
+    def load(self):
+        """Loads the channels from self.path, if it exists"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as channels_file:
+                entries = json.load(channels_file)
+        except (OSError, ValueError) as e:
+            print("Failed to load channels from " + self.path)
+            print(e)
+            return
+        names = []
+        channels = {}
+        for entry in entries:
+            try:
+                channel = str(entry["number"])
+                if entry.get("sub_channel") is not None:
+                    channel += "." + str(entry["sub_channel"])
+                for name in [entry["name"]] + list(entry.get("aliases", [])):
+                    names.append(name)
+                    channels[normalize_name(name)] = channel
+            except (KeyError, TypeError):
+                print("Skipping channel without a name and number: " + repr(entry))
+        self.names = names
+        self.channels = channels
+
+    def lookup(self, name):
+        """Returns the channel for a name, as the number and any sub-channel
+        separated by a ".", or None if there's no such channel"""
+        return self.channels.get(normalize_name(name))
+
+__all__ = ["CHANNELS_SLOT", "ChannelDirectory", "normalize_name"]
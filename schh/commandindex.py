@@ -0,0 +1,158 @@
+"""Provides CommandIndex for finding the Harmony Hub command for a label"""
+from collections import namedtuple
+import json
+import sys
+
+from schh.fuzzy import FuzzyIndex
+
+# What to send to the Harmony Hub for a function in an activity
+CommandEntry = namedtuple("CommandEntry", ["device", "command", "activity"])
+
+# Labels the ASR can't produce as they are
+VOICE_LABELS = {
+    "0": "zero",
+    "1": "one",
+    "2": "two",
+    "3": "three",
+    "4": "four",
+    "5": "five",
+    "6": "six",
+    "7": "seven",
+    "8": "eight",
+    "9": "nine",
+}
+
+def voice_command(label):
+    """Returns the words used to say a function's label"""
+    return VOICE_LABELS.get(label, label)
+
+def normalize_label(label):
+    """Returns the form of a label used as a key in the index"""
+    return voice_command(label).lower().replace(" ", "_")
+
+def parse_action(function):
+    """Returns the device ID and command for a function from the config,
+    or None if its action doesn't name a device"""
+    try:
+        action = json.loads(function["action"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not isinstance(action, dict) or "deviceId" not in action:
+        return None
+    return (str(action["deviceId"]), action.get("command", function["name"]))
+
+class CommandIndex:
+    """Table of every function in every activity, keyed by activity ID and
+    normalized label, built once per version of the hub's configuration,
+    with a FuzzyIndex of the same for labels that don't match exactly.
+    Labels that aren't in an activity at all are looked for in the others,
+    so that e.g. "mute" still finds a device to mute"""
+    def __init__(self):
+        """Initialize members"""
+        self.version = None
+        self.entries = {}
+        self.fuzzy = FuzzyIndex()
+        self.by_label = {}
+        self.label_index = FuzzyIndex()
+        self.activity_devices = {}
+        self.voice_commands = []
+
+    def _set_entries(self, entries):
+        functions = {}
+        activity_devices = {}
+        for ((activity_id, label), entry) in entries.items():
+            activity_devices.setdefault(activity_id, set()).add(entry.device)
+            functions.setdefault(label, {}).setdefault((entry.device, entry.command), []).append(entry)
+        # Each label's functions in any activity, the one in the most
+        # activities first
+        by_label = {}
+        for (label, found) in functions.items():
+            by_label[label] = [entries_found[0] for entries_found in
+                    sorted(found.values(), key=lambda entries_found: -len(entries_found))]
+
+        self.fuzzy = FuzzyIndex([(activity_id, label, entry)
+                for ((activity_id, label), entry) in entries.items()])
+        self.by_label = by_label
+        self.label_index = FuzzyIndex([(None, label, label) for label in by_label])
+        self.activity_devices = dict([(activity_id, frozenset(devices))
+                for (activity_id, devices) in activity_devices.items()])
+        self.entries = entries
+
+    def build(self, config, version):
+        """Rebuilds the index from config, unless it was already built from
+        this version"""
+        if version == self.version:
+            return
+        entries = {}
+        voice_commands = set()
+        for activity in config["activity"]:
+            activity_id = sys.intern(str(activity["id"]))
+            for cgroups in activity.get("controlGroup", []):
+                for fncn in cgroups["function"]:
+                    action = parse_action(fncn)
+                    if action is None:
+                        continue
+                    # The same devices and commands show up in many
+                    # activities; interning keeps big configurations compact
+                    device = sys.intern(action[0])
+                    command = sys.intern(str(action[1]))
+                    label = fncn["label"]
+                    voice_commands.add(voice_command(label))
+                    entries[(activity_id, normalize_label(label))] = CommandEntry(device, command, activity_id)
+
+        self._set_entries(entries)
+        self.voice_commands = sorted(voice_commands)
+        self.version = version
+
+    def dump(self):
+        """Returns the index as a list of [activity ID, normalized label,
+        device, command] rows, e.g. for saving in a Snapshot"""
+        return [[activity_id, label, entry.device, entry.command]
+                for ((activity_id, label), entry) in self.entries.items()]
+
+    def restore(self, rows, voice_commands, version):
+        """Replaces the index with rows returned by dump(), as built from
+        the given version of the configuration"""
+        entries = {}
+        for (activity_id, label, device, command) in rows:
+            activity_id = sys.intern(activity_id)
+            entries[(activity_id, label)] = CommandEntry(sys.intern(device),
+                    sys.intern(command), activity_id)
+        self._set_entries(entries)
+        self.voice_commands = list(voice_commands)
+        self.version = version
+
+    def lookup(self, activity_id, label):
+        """Returns the CommandEntry for label in the activity, or the same
+        function in another activity, or failing those the closest match
+        to it, or None.  Near misses in the activity only win over an exact
+        match elsewhere if they have the same words"""
+        activity_id = str(activity_id)
+        command = voice_command(label)
+        entry = self.entries.get((activity_id, normalize_label(label)))
+        if entry is None:
+            entry = self.fuzzy.lookup(command, activity_id, by_sound=False)
+        if entry is None:
+            entry = self._lookup_any(activity_id, normalize_label(label))
+        if entry is None:
+            entry = self.fuzzy.lookup(command, activity_id)
+        if entry is None:
+            found = self.label_index.lookup(command)
+            if found is not None:
+                entry = self._lookup_any(activity_id, found)
+        return entry
+
+    def _lookup_any(self, activity_id, label):
+        """Returns the CommandEntry for the normalized label in any
+        activity, preferring devices that are part of the given one, or
+        None"""
+        candidates = self.by_label.get(label)
+        if candidates is None:
+            return None
+        devices = self.activity_devices.get(activity_id, frozenset())
+        for entry in candidates:
+            if entry.device in devices:
+                return entry
+        return candidates[0]
+
+__all__ = ["CommandEntry", "CommandIndex", "normalize_label", "voice_command"]
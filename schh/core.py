@@ -0,0 +1,690 @@
+"""Provides HarmonyHubCore, the transport-neutral part of SmartCommandsHarmonyHub"""
+import asyncio
+from threading import Thread
+from time import monotonic
+
+from hermes_python.ontology.injection import (InjectionRequestMessage, AddFromVanillaInjectionRequest)
+
+from schh.breaker import CircuitBreaker
+from schh.commandindex import CommandIndex
+from schh.delays import DelayProfiles
+from schh.hubstate import ActivityState, HubConfigCache
+from schh.injection import ACTIVITIES_SLOT, COMMANDS_SLOT
+from schh.metrics import Metrics, timed
+from schh.snapshot import Snapshot
+from schh.volume import VOLUME_MAX, VolumeTracker
+from schh.scheduler import (CommandScheduler, PRIORITY_BULK, PRIORITY_INTERACTIVE,
+        PRIORITY_NORMAL, TIMED_OUT, coalesce_key, command_priority, merge_sends)
+
+# Seconds of idle time between checks on a persistent connection
+KEEPALIVE_INTERVAL = 30
+
+# Seconds to wait for each operation, by name, when none are given;
+# "default" is for the rest
+TIMEOUTS = {"default": 10, "start_activity": 30, "set_volume": 30}
+
+# Seconds to wait for a connection to close
+CLOSE_TIMEOUT = 5
+
+class SendFailed(Exception):
+    """Raised by a driver when the hub stops answering part way through a
+    list of sends"""
+    def __init__(self, send, cause=None):
+        """Initialize members
+
+        send: The (device, command, count, delay) send that failed
+        cause: The exception that stopped it
+        """
+        super().__init__("Failed to send {} to device {}: {}".format(send[1], send[0], cause))
+        self.send = send
+
+def normalize_channel(channel_slot, separator="."):
+    """Returns the channel to send to the hub for what was said, rounding
+    any sub-channel to one digit and using the given separator for digital
+    channels"""
+    which_channel = ""
+    dot_reached = False
+    sub_channel = 0
+    for idx in range(len(channel_slot)):
+        if channel_slot[idx].isdigit() and not dot_reached:
+            which_channel += channel_slot[idx]
+        elif channel_slot[idx] == "." or channel_slot[idx] == ",":
+            which_channel += separator
+            dot_reached = True
+            idx += 1
+            break
+
+    if dot_reached:
+        if len(channel_slot) > idx:
+            sub_channel = int(channel_slot[idx])
+            if len(channel_slot) > idx+1 and int(channel_slot[idx+1]) >= 5:
+                sub_channel += 1
+            which_channel += str(sub_channel)
+    return which_channel
+
+class HarmonyHubCore:
+    """Everything SmartCommandsHarmonyHub does that doesn't depend on how
+    it talks to the Harmony Hub: caching the config and current activity,
+    the command index, channel normalization, scheduling, coalescing and
+    the circuit breaker.  Subclasses set driver_class to the transport.
+
+    A driver is created with the hub's address, the core (to call back
+    with on_connect, on_disconnect, on_activity and on_config_changed) and
+    the event loop its coroutines run on, and provides channel_separator,
+    reports_rejects (True if send_commands can tell when the hub rejected
+    a press, so delays can be learned from it) and these coroutines:
+        connect(subscribe): True if connected; subscribe asks for the
+        hub's notifications
+        close(clean): Closes the connection; clean is False if it failed
+        fetch_config(fresh): Returns the hub's config; fresh is True just
+        after connecting
+        get_current_activity(): Returns the current activity's ID
+        start_activity(activity_id): True if the hub accepted it
+        send_commands(sends, should_stop): Sends (device, command, count,
+        delay) sends, stopping early if should_stop() returns True;
+        returns the IDs of devices the hub rejected a command for
+        change_channel(channel): True if the hub accepted it
+    """
+    driver_class = None
+
+    def __init__(self, remote_address, connection="persistent", config_ttl=0,
+            coalesce_window=0, delays=None, snapshot=None, metrics=None, timeouts=None,
+            idle_close=0, volume_max=VOLUME_MAX):
+        """Initialize members
+
+        remote_address: The host name or IP address of the Harmony Hub
+        connection: "persistent" to keep one connection open to the
+        Harmony Hub, or "per_call" to connect and disconnect for every
+        request
+        config_ttl: Seconds to keep using the hub's configuration before
+        downloading it again, or 0 to wait for the hub to report a change
+        coalesce_window: Seconds to hold a command while waiting for more
+        of the same to send with it
+        delays: DelayProfiles giving the time between repeats for each
+        device
+        snapshot: Snapshot to start from, and to keep up to date
+        metrics: Metrics to record timings in
+        timeouts: Seconds to wait for each operation, by name, before
+        cancelling it and dropping the connection; "default" is for the
+        rest, and 0 waits forever
+        idle_close: Seconds without a request after which a persistent
+        connection is closed, until the next request or prewarm(); 0
+        keeps it open
+        volume_max: Volume steps from silent to loudest, for set_volume
+        """
+        self.loop = asyncio.new_event_loop()
+        # A daemon, so a hub that's never closed can't keep the process
+        # from exiting
+        self.thread = Thread(target=self._asyncio_thread_loop, daemon=True)
+        self.thread.start()
+        self.remote_address = remote_address
+        self.persistent = connection != "per_call"
+        self.connected = False
+        self.cache = HubConfigCache(config_ttl)
+        self.activity = ActivityState()
+        self.command_index = CommandIndex()
+        self.delays = delays if delays is not None else DelayProfiles()
+        self.volume = VolumeTracker(volume_max)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.snapshot = snapshot if snapshot is not None else Snapshot()
+        self.timeouts = timeouts if timeouts is not None else TIMEOUTS
+        self.idle_close = idle_close
+        self.last_used = monotonic()
+        self.warming = None
+        self.refreshing = None
+        if self.snapshot.config is not None:
+            self.cache.restore(self.snapshot.config)
+            self.command_index.restore(self.snapshot.commands,
+                    self.snapshot.voice_commands, self.cache.version)
+        self.cache.listeners.append(self._save_snapshot)
+        self.driver = self.driver_class(remote_address, self, self.loop)
+        self.breaker = CircuitBreaker(self._probe)
+        # Every request goes through the scheduler, so one request at a
+        # time uses the connection and the state above
+        if self.persistent:
+            idle_interval = KEEPALIVE_INTERVAL
+            if idle_close:
+                idle_interval = min(idle_interval, idle_close)
+            self.scheduler = CommandScheduler(self._keepalive, idle_interval,
+                    coalesce_window, self.metrics)
+            self.scheduler.submit(self._run_connected, self._reached, (),
+                    timeout=self._timeout("connect"))
+        else:
+            self.scheduler = CommandScheduler(coalesce_window=coalesce_window,
+                    metrics=self.metrics)
+
+    def _asyncio_thread_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _stop_event_loop(self):
+        self.loop.stop()
+        return self.loop.is_running()
+
+    def _reset_state_info(self):
+        """Resets state-related members to their defaults"""
+        self.activity.reset()
+
+    def _timeout(self, operation):
+        """Returns the seconds to wait for the named operation, or None to
+        wait forever"""
+        return self.timeouts.get(operation, self.timeouts.get("default")) or None
+
+    def _run(self, function, *args, priority=PRIORITY_NORMAL, preemptible=False,
+            operation="default"):
+        """Runs the coroutine function with args on the event loop, once
+        connected to the Harmony Hub, and returns its result, -1 if the
+        connection failed or the hub is known to be unreachable, or
+        TIMED_OUT if it took longer than the operation's timeout"""
+        if not self.breaker.allow():
+            return -1
+        return self.scheduler.run(self._run_connected, function, args,
+                priority=priority, preemptible=preemptible,
+                timeout=self._timeout(operation))
+
+    def _run_connected(self, function, args):
+        """Runs on the scheduler's thread, which owns the connection"""
+        self.last_used = monotonic()
+        return_value = self._call_connected(function, args)
+        if return_value in (-1, TIMED_OUT):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return return_value
+
+    def _call_connected(self, function, args):
+        return self._call_in_loop(self._with_connection(function, args),
+                self.scheduler.time_left())
+
+    async def _with_connection(self, function, args):
+        if self.persistent:
+            if not await self._ensure_connected():
+                return -1
+            try:
+                if self.cache.config is None:
+                    await self._refresh_config()
+                elif self.cache.is_stale():
+                    # Answer from the cached configuration rather than make
+                    # the caller wait for it to be downloaded
+                    self._refresh_later()
+                return await function(*args)
+            except Exception as e:
+                print("Caught exception while talking to Harmony Hub!")
+                print(e)
+                await self._drop_connection()
+                return -1
+
+        if not await self._connect():
+            return -1
+        try:
+            return_value = await function(*args)
+        except Exception as e:
+            print("Caught exception while talking to Harmony Hub!")
+            print(e)
+            await self._drop_connection()
+            return -1
+        await self._close()
+        return return_value
+
+    async def _reached(self):
+        return 1
+
+    async def _update_config(self):
+        await self._refresh_config()
+        return 1
+
+    def _refresh_later(self):
+        """Downloads the hub's configuration in the background, once the
+        hub isn't busy with anything else, unless that's already queued;
+        until then, the cached one is used"""
+        if self.refreshing is not None and not self.refreshing.done():
+            return
+        # Preemptible, so as not to stop anything already being sent
+        self.refreshing = self.scheduler.submit(self._run_connected, self._update_config, (),
+                priority=PRIORITY_BULK, preemptible=True, timeout=self._timeout("connect"))
+
+    def _probe(self):
+        """Tries to reach the Harmony Hub, for the circuit breaker"""
+        return self.scheduler.run(self._call_connected, self._reached, (),
+                priority=PRIORITY_INTERACTIVE, timeout=self._timeout("connect")) == 1
+
+    async def _connect(self):
+        """Connects to the Harmony Hub"""
+        try:
+            with self.metrics.timer("schh_hub_phase_seconds", phase="connect"):
+                connected = await self.driver.connect(self.persistent)
+            if not connected:
+                print("Failed to connect to Harmony Hub: " + self.remote_address)
+                print("Try using the IP address instead of hostname")
+                return False
+            self.connected = True
+            await self._refresh_config(True)
+            self._set_activity(await self.driver.get_current_activity())
+            return True
+        except Exception as e:
+            print("Caught exception while connecting to Harmony Hub!")
+            print(e)
+            await self._drop_connection()
+        return False
+
+    async def _ensure_connected(self):
+        """Opens the persistent connection if it isn't already open"""
+        if self.connected:
+            return True
+        # Whatever is left of a connection that dropped is no use
+        await self._drop_connection()
+        return await self._connect()
+
+    async def _close(self):
+        """Closes the connectoion to the Harmony Hub"""
+        self.connected = False
+        await self.driver.close(True)
+        self._reset_state_info()
+        if not self.cache.ttl:
+            # The hub can't tell us about changes while we're away
+            self.cache.invalidate()
+
+    async def _drop_connection(self):
+        """Abandons a failed connection, so the next request reconnects"""
+        self.connected = False
+        try:
+            await asyncio.wait_for(self.driver.close(False), CLOSE_TIMEOUT)
+        except Exception:
+            pass
+        self._reset_state_info()
+
+    def _keepalive(self):
+        """Runs on the scheduler's thread when it's idle; saves any delay
+        profiles that are due, and checks the persistent connection, and
+        reconnects if it has gone away or downloads the configuration if
+        it has expired, unless it has been idle for idle_close seconds, in
+        which case it's closed"""
+        self.delays.save_if_due()
+        if self.idle_close and monotonic() - self.last_used >= self.idle_close:
+            if self.connected:
+                print("Closing idle connection to Harmony Hub")
+                self._call_in_loop(self._close(), CLOSE_TIMEOUT)
+            return
+        self._call_in_loop(self._check_connection(), self._timeout("connect"))
+
+    def _call_in_loop(self, co_routine, timeout=None):
+        """Runs co_routine on the event loop and returns its result, -1 if
+        it raised, or TIMED_OUT if it was cancelled after timeout seconds"""
+        if timeout is not None:
+            co_routine = self._with_timeout(co_routine, timeout)
+        try:
+            return asyncio.run_coroutine_threadsafe(co_routine, self.loop).result()
+        except Exception as e:
+            print("Caught exception while talking to Harmony Hub!")
+            print(e)
+            return -1
+
+    async def _with_timeout(self, co_routine, timeout):
+        try:
+            return await asyncio.wait_for(co_routine, timeout)
+        except asyncio.TimeoutError:
+            print("Timed out waiting for Harmony Hub")
+            # Whatever the connection was waiting for may never come, so
+            # don't trust it with anything else
+            await self._drop_connection()
+            return TIMED_OUT
+
+    async def _warm(self):
+        if not self.activity.valid:
+            self._set_activity(await self.driver.get_current_activity())
+        return 1
+
+    def prewarm(self):
+        """Gets the persistent connection ready for a request that's likely
+        to follow, e.g. once someone has said the hotword, without waiting
+        for it: connects if need be, and brings the configuration and
+        current activity up to date.  Returns True if there was anything to
+        do"""
+        if not self.persistent or not self.breaker.allow():
+            return False
+        if self._is_activity_known() and not self.cache.is_stale():
+            return False
+        if self.warming is not None and not self.warming.done():
+            return False
+        # Preemptible, so as not to stop anything already being sent
+        self.warming = self.scheduler.submit(self._run_connected, self._warm, (),
+                priority=PRIORITY_INTERACTIVE, preemptible=True,
+                timeout=self._timeout("connect"))
+        return True
+
+    async def _check_connection(self):
+        if not self.connected:
+            # While the circuit is open, the breaker does the reconnecting
+            if self.breaker.allow():
+                await self._ensure_connected()
+            return
+        try:
+            self._set_activity(await self.driver.get_current_activity())
+            # Nothing is waiting, so now's the time to download a
+            # configuration that has expired
+            await self._refresh_config()
+        except Exception as e:
+            print("Lost connection to Harmony Hub, reconnecting")
+            print(e)
+            await self._drop_connection()
+            await self._ensure_connected()
+
+    async def _refresh_config(self, fresh=False):
+        """Downloads the hub's configuration if the cached one is out of
+        date
+
+        fresh: True just after connecting
+        """
+        if self.cache.is_stale():
+            with self.metrics.timer("schh_hub_phase_seconds", phase="config_fetch"):
+                config = await self.driver.fetch_config(fresh)
+            self.cache.update(config)
+
+    def _set_activity(self, activity_id):
+        """Updates the current activity, taking its name from the config"""
+        self.activity.set_current(activity_id, self.cache.get_activity_name(activity_id))
+
+    def _is_activity_known(self):
+        """Returns True if the hub is keeping self.activity up to date"""
+        return self.persistent and self.connected and self.activity.valid
+
+    def on_connect(self, activity_id=None):
+        """Called by the driver when a dropped connection comes back by
+        itself"""
+        self.connected = True
+        self.breaker.record_success()
+        if activity_id is not None:
+            self._set_activity(activity_id)
+
+    def on_disconnect(self):
+        """Called by the driver when the connection drops"""
+        self.connected = False
+        self.activity.invalidate()
+
+    def on_activity(self, activity_id, starting=False):
+        """Called by the driver when the hub begins switching activities,
+        if starting, or has switched"""
+        if starting:
+            self.activity.set_starting(activity_id, self.cache.get_activity_name(activity_id))
+        else:
+            self._set_activity(activity_id)
+
+    def on_config_changed(self, config=None):
+        """Called by the driver when the hub reports a new configuration;
+        config is it, if the driver already has it"""
+        if config is not None:
+            self.cache.update(config)
+            return
+        self.cache.invalidate()
+        self._refresh_later()
+
+    def _get_commands_payload(self, commands):
+        return AddFromVanillaInjectionRequest({COMMANDS_SLOT: commands})
+
+    def _get_activities_payload(self, activities):
+        return AddFromVanillaInjectionRequest({ACTIVITIES_SLOT: activities})
+
+    async def _get_update_payload(self):
+        """ Finds all the commands and returns a payload for injecting
+        commands """
+        vocabulary = self._get_vocabulary()
+        operations = []
+        operations.append(self._get_activities_payload(vocabulary[ACTIVITIES_SLOT]))
+        operations.append(self._get_commands_payload(vocabulary[COMMANDS_SLOT]))
+        return InjectionRequestMessage(operations)
+
+    def _get_vocabulary(self):
+        """Returns the activity and command names to inject, by slot"""
+        self._update_command_index()
+        return {
+            ACTIVITIES_SLOT: self.cache.list_activities(),
+            COMMANDS_SLOT: list(self.command_index.voice_commands),
+        }
+
+    def _save_snapshot(self, _):
+        """Called when the configuration changes; saves it in the snapshot"""
+        self._update_command_index()
+        self.snapshot.set_config(self.cache.config, self.command_index)
+
+    def _update_command_index(self):
+        """Rebuilds the command index if the configuration has changed"""
+        self.command_index.build(self.cache.config, self.cache.version)
+
+    def _map_command(self, command):
+        """Maps from a command label to a command"""
+        self._update_command_index()
+        return self.command_index.lookup(self.activity.activity_id, command)
+
+    async def _change_channel(self, which_channel):
+        with self.metrics.timer("schh_hub_phase_seconds", phase="send"):
+            ret_value = await self.driver.change_channel(which_channel)
+        return 1 if ret_value else 0
+
+    @timed("schh_hub_operation_seconds", operation="change_channel")
+    def change_channel(self, channel_slot, exact=False):
+        """Changes to the specified channel, being sure that if digital
+        channels are used, that it uses the correct separator style.
+
+        exact: True if channel_slot is already a channel, e.g. from the
+        channel directory, rather than what was said, so any sub-channel
+        is sent as it is instead of being rounded
+        """
+        if exact:
+            which_channel = channel_slot.replace(".", self.driver.channel_separator)
+        else:
+            which_channel = normalize_channel(channel_slot, self.driver.channel_separator)
+        return self._run(self._change_channel, which_channel, operation="change_channel")
+
+    def _map_sends(self, items):
+        """Maps a batch of (command, repeat, delay) items to merged
+        (device, command, count, delay) sends; returns the sends and a
+        result for each item"""
+        results = []
+        sends = []
+        for (command, repeat, delay) in items:
+            mapped_command = self._map_command(command)
+            if mapped_command is None or repeat < 1:
+                results.append(0)
+                continue
+            if delay is None:
+                delay = self.delays.get(mapped_command.device)
+            sends.append((mapped_command.device, mapped_command.command, repeat, delay))
+            results.append(1)
+        return (merge_sends(sends), results)
+
+    async def _send(self, sends):
+        """Sends a list of (device, command, count, delay) sends in one go,
+        and records how the hub took them"""
+        try:
+            with self.metrics.timer("schh_hub_phase_seconds", phase="send"):
+                failed_devices = await self.driver.send_commands(sends,
+                        self.scheduler.is_preempted)
+        except SendFailed as e:
+            if self.driver.reports_rejects:
+                self.delays.record_sends([e.send], [e.send[0]])
+            self.volume.forget(e.send[0])
+            raise
+        if self.driver.reports_rejects:
+            self.delays.record_sends(sends, failed_devices)
+        if self.scheduler.is_preempted():
+            # Nobody knows how many of the steps were sent
+            failed_devices = set(failed_devices).union([str(send[0]) for send in sends])
+        self.volume.record_sends(sends, failed_devices)
+
+    async def _send_mapped(self, items):
+        (sends, results) = self._map_sends(items)
+        if sends:
+            await self._send(sends)
+        return results
+
+    def _send_batch(self, items):
+        """Runs on the scheduler's thread; sends a coalesced batch of
+        (command, repeat, delay) items together"""
+        results = self._run_connected(self._send_mapped, (items,))
+        if results in (-1, TIMED_OUT):
+            return [results] * len(items)
+        return results
+
+    @timed("schh_hub_operation_seconds", operation="send_command")
+    def send_command(self, command, repeat, delay=None, priority=None):
+        """Sends command to the Harmony Hub repeat times; sends of the same
+        command that arrive together are combined
+
+        delay: Seconds between repeats, if not the device's usual delay
+        priority: The scheduler priority, if not the one for the command
+        """
+        if priority is None:
+            priority = command_priority(command)
+        if not self.breaker.allow():
+            return -1
+        return self.scheduler.send(self._send_batch, (command, repeat, delay),
+                coalesce_key(command), priority=priority,
+                preemptible=repeat > 1 or priority == PRIORITY_BULK,
+                timeout=self._timeout("send_command"))
+
+    async def _set_volume(self, level):
+        volume_up = self._map_command("Volume Up")
+        volume_down = self._map_command("Volume Down")
+        if volume_up is None or volume_down is None or volume_up.device != volume_down.device:
+            return 0
+        device = volume_up.device
+        sends = self.volume.sends_to(device, level, volume_up.command, volume_down.command,
+                self.delays.get(device))
+        if sends:
+            await self._send(sends)
+        return 1
+
+    @timed("schh_hub_operation_seconds", operation="set_volume")
+    def set_volume(self, level):
+        """Sets the volume of the current activity's volume device to level
+        steps above silent, sending every step in one batch; returns 1, or
+        0 if the activity has no volume control"""
+        return self._run(self._set_volume, level, operation="set_volume")
+
+    async def _list_activities(self):
+        return self.cache.list_activities()
+
+    @timed("schh_hub_operation_seconds", operation="list_activities")
+    def list_activities(self):
+        """Returns a list of activities"""
+        if not self.cache.is_stale():
+            return self.cache.list_activities()
+        if self.cache.config is not None and (self.cache.restored or not self.breaker.allow()):
+            # Either the hub hasn't been reached since starting from the
+            # snapshot, or it's unreachable, so this is the best there is
+            return self.cache.list_activities()
+        return self._run(self._list_activities, operation="list_activities")
+
+    async def _current_activity(self):
+        return self.activity.current()
+
+    @timed("schh_hub_operation_seconds", operation="current_activity")
+    def current_activity(self):
+        """Returns the ID and name of the current activity"""
+        if self._is_activity_known():
+            return self.activity.current()
+        return self._run(self._current_activity, operation="current_activity")
+
+    def _resolve_activity(self, activity_name):
+        """Returns the configured name of the activity that activity_name
+        matches, or activity_name if none does"""
+        activity_id = self.cache.get_activity_id(activity_name)
+        if activity_id is None:
+            return activity_name
+        return self.cache.get_activity_name(activity_id) or activity_name
+
+    async def _start_activity(self, activity_name):
+        activity_name = self._resolve_activity(activity_name)
+        if self.activity.is_current_or_starting(activity_name):
+            print("current activity is the same as what was requested, doing nothing")
+            return -2
+
+        activity_id = self.cache.get_activity_id(activity_name)
+        if activity_id is None:
+            print("Cannot find the activity: {} ".format(activity_name))
+            return -3
+
+        with self.metrics.timer("schh_hub_phase_seconds", phase="send"):
+            return_value = await self.driver.start_activity(activity_id)
+        if return_value:
+            self._set_activity(activity_id)
+        return 1 if return_value else 0
+
+    @timed("schh_hub_operation_seconds", operation="start_activity")
+    def start_activity(self, activity_name):
+        """Starts an activity on the Harmony Hub"""
+        if self._is_activity_known() and self.activity.is_current_or_starting(
+                self._resolve_activity(activity_name)):
+            print("current activity is the same as what was requested, doing nothing")
+            return -2
+        return self._run(self._start_activity, activity_name, priority=PRIORITY_BULK,
+                operation="start_activity")
+
+    def power_off(self):
+        """Sets the current activity of the Harmony Hub to -1, AKA "PowerOff"."""
+        return self.start_activity("PowerOff")
+
+    @timed("schh_hub_operation_seconds", operation="get_injection_payload")
+    def get_injection_payload(self):
+        """Injects the list of activities known to the Harmony Hub"""
+        payload = self._run(self._get_update_payload, priority=PRIORITY_BULK,
+                operation="get_vocabulary")
+        if payload in (-1, TIMED_OUT):
+            return None
+        return payload
+
+    @timed("schh_hub_operation_seconds", operation="get_vocabulary")
+    def get_vocabulary(self, refresh=True):
+        """Returns the activity and command names to inject, by slot, or
+        None if the configuration couldn't be downloaded
+
+        refresh: False to answer from the cached configuration, even if it
+        is stale, without contacting the hub
+        """
+        if refresh and self.cache.is_stale():
+            self._run(self._update_config, priority=PRIORITY_BULK, operation="get_vocabulary")
+        if self.cache.config is None:
+            return None
+        return self._get_vocabulary()
+
+    def add_config_listener(self, listener):
+        """Calls listener with the new version each time the Harmony Hub's
+        configuration changes; it may be called on any thread"""
+        self.cache.listeners.append(listener)
+
+    def health(self):
+        """Returns a dict describing the connection to the Harmony Hub"""
+        return {
+            "remote_address": self.remote_address,
+            "connected": self.connected,
+            "circuit": self.breaker.health(),
+            "config_version": self.cache.version,
+            "config_stale": self.cache.is_stale(),
+            "activity": self.activity.current() if self.activity.valid else None,
+            "queued": len(self.scheduler.requests),
+        }
+
+    async def _close_persistent(self):
+        if self.connected:
+            await self._close()
+        else:
+            await self._drop_connection()
+
+    def save(self):
+        """Saves what has been learned about the hub's devices that hasn't
+        been saved yet, e.g. before exiting"""
+        self.delays.close()
+
+    def close(self):
+        self.breaker.close()
+        self.scheduler.close()
+        self.delays.close()
+        self._call_in_loop(self._close_persistent(), CLOSE_TIMEOUT)
+        asyncio.run_coroutine_threadsafe(
+                self._stop_event_loop(),
+                self.loop)
+        self.thread.join()
+        self.loop.close()
+
+__all__ = ["CLOSE_TIMEOUT", "HarmonyHubCore", "KEEPALIVE_INTERVAL", "SendFailed", "TIMEOUTS",
+        "TIMED_OUT", "normalize_channel"]
@@ -0,0 +1,142 @@
+"""Provides DelayProfiles for per-device spacing between repeated commands"""
+import json
+import os
+from threading import Lock
+from time import monotonic
+
+# Version of the file DelayProfiles are saved in
+PROFILES_VERSION = 1
+
+# Seconds between saves of learned profiles
+SAVE_INTERVAL = 60
+
+class DelayProfiles:
+    """Holds how long to wait between repeats of a command for each device.
+    When learning, a device's delay shrinks a little after every repeated
+    send the hub accepts, and grows again after one it rejects, settling
+    just above the fastest spacing the device handles reliably"""
+    def __init__(self, path=None, default=0.1, minimum=0.03, maximum=1.0,
+            configured=None, learn=False):
+        """Initialize members
+
+        path: File the learned profiles are loaded from and saved to, or
+        None to keep them in memory only
+        default: Seconds between repeats for devices with no profile
+        minimum: The shortest delay that will be learned
+        maximum: The longest delay that will be learned
+        configured: dict of device ID to a starting delay in seconds
+        learn: True to adjust delays from the hub's responses
+        """
+        self.path = path
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.learn = learn
+        self.lock = Lock()
+        self.profiles = {}
+        self.changed = False
+        self.saved = monotonic()
+        for (device, delay) in (configured or {}).items():
+            self.profiles[str(device)] = {"delay": float(delay), "floor": 0}
+        self.load()
+
+    def get(self, device):
+        """Returns the delay in seconds to use between repeats for device"""
+        profile = self.profiles.get(device)
+        if profile is None:
+            return self.default
+        return profile["delay"]
+
+    def _profile(self, device):
+        if device not in self.profiles:
+            self.profiles[device] = {"delay": self.default, "floor": 0}
+        return self.profiles[device]
+
+    def record_success(self, device, delay):
+        """Records that repeats sent delay seconds apart all worked"""
+        if not self.learn:
+            return
+        with self.lock:
+            profile = self._profile(device)
+            if delay > profile["delay"]:
+                return
+            # Narrow towards, but never down to, the fastest spacing that
+            # has failed
+            narrowed = round(max(self.minimum, profile["floor"] * 1.1, delay * 0.9), 3)
+            if narrowed < profile["delay"]:
+                profile["delay"] = narrowed
+                self.changed = True
+        self.save_if_due()
+
+    def record_failure(self, device, delay):
+        """Records that repeats sent delay seconds apart were rejected"""
+        if not self.learn:
+            return
+        with self.lock:
+            profile = self._profile(device)
+            profile["floor"] = min(self.maximum, max(profile["floor"], delay))
+            profile["delay"] = min(self.maximum, max(profile["delay"], delay * 2))
+            self.changed = True
+        self.save_if_due()
+
+    def record_sends(self, sends, failed_devices):
+        """Learns from a list of (device, command, count, delay) sends,
+        given the IDs of devices the hub rejected a command for"""
+        for (device, _, count, delay) in sends:
+            # Only repeats say anything about the spacing
+            if count < 2:
+                continue
+            if device in failed_devices:
+                self.record_failure(device, delay)
+            else:
+                self.record_success(device, delay)
+
+    def load(self):
+        """Loads learned profiles from self.path, if it exists"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as profiles_file:
+                saved = json.load(profiles_file)
+        except (OSError, ValueError) as e:
+            print("Failed to load delay profiles from " + self.path)
+            print(e)
+            return
+        if saved.get("version") != PROFILES_VERSION:
+            return
+        with self.lock:
+            for (device, profile) in saved.get("devices", {}).items():
+                self.profiles[device] = {
+                    "delay": float(profile["delay"]),
+                    "floor": float(profile.get("floor", 0)),
+                }
+
+    def save(self):
+        """Saves the profiles to self.path"""
+        if self.path is None:
+            return
+        with self.lock:
+            devices = dict([(device, dict(profile)) for (device, profile) in self.profiles.items()])
+            saved = {"version": PROFILES_VERSION, "devices": devices}
+            self.changed = False
+            self.saved = monotonic()
+        try:
+            with open(self.path + ".tmp", "w") as profiles_file:
+                json.dump(saved, profiles_file, indent=1, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print("Failed to save delay profiles to " + self.path)
+            print(e)
+
+    def save_if_due(self):
+        """Saves the profiles if they've changed and haven't been saved
+        recently"""
+        if self.changed and monotonic() - self.saved > SAVE_INTERVAL:
+            self.save()
+
+    def close(self):
+        """Saves any unsaved changes"""
+        if self.changed:
+            self.save()
+
+__all__ = ["DelayProfiles"]
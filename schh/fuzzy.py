@@ -0,0 +1,105 @@
+"""Provides FuzzyIndex for finding a label from the way it was said"""
+import re
+
+# Digits for consonants that sound alike, as in Soundex
+PHONETIC_CODES = dict(
+        [(char, "1") for char in "bfpv"] +
+        [(char, "2") for char in "cgjkqsxz"] +
+        [(char, "3") for char in "dt"] +
+        [("l", "4")] +
+        [(char, "5") for char in "mn"] +
+        [("r", "6")])
+
+# Marks a key shared by labels for different values
+_AMBIGUOUS = object()
+
+def label_words(label):
+    """Returns the words of a label in lower case, splitting camel case and
+    dropping punctuation, e.g. "ChannelUp" gives ["channel", "up"]"""
+    label = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", label)
+    return re.sub(r"[\W_]+", " ", label.casefold()).split()
+
+def phonetic(text):
+    """Returns a code for how text sounds: consonants that sound alike
+    share a digit, as in Soundex, silent h is dropped, and repeats are
+    collapsed.  Unlike Soundex, vowels are kept, so e.g. "mute" and "mode"
+    stay apart"""
+    code = []
+    for char in text:
+        if char == "h":
+            continue
+        sound = PHONETIC_CODES.get(char, char)
+        if not code or code[-1] != sound:
+            code.append(sound)
+    return "".join(code)
+
+def fuzzy_keys(label):
+    """Returns the keys a label is indexed under, from the closest match to
+    the loosest: its words run together, and its words in any order; there
+    are none for a label without any words"""
+    words = label_words(label)
+    if not words:
+        return []
+    return ["".join(words), " ".join(sorted(set(words)))]
+
+class FuzzyIndex:
+    """Finds the value for a label regardless of case, punctuation,
+    spacing, camel case or word order.  Labels are indexed once under each
+    of their keys, so a lookup is a few dict lookups however many labels
+    there are; a key that labels for different values share finds nothing,
+    rather than a guess.
+
+    Failing those, a label is found by how it sounds, but only if no other
+    label in the index sounds the same, whatever its scope: pressing a
+    button that merely sounds like the one asked for is worse than saying
+    it wasn't found"""
+    def __init__(self, items=()):
+        """Initialize members
+
+        items: (scope, label, value) to add; a lookup only finds labels
+        added with the same scope
+        """
+        self.keys = {}
+        self.sounds = {}
+        for (scope, label, value) in items:
+            self.add(label, value, scope)
+
+    def add(self, label, value, scope=None):
+        """Adds label, to be found as value"""
+        keys = fuzzy_keys(label)
+        if not keys:
+            return
+        for (level, key) in enumerate(keys):
+            existing = self.keys.get((scope, level, key))
+            if existing is None:
+                self.keys[(scope, level, key)] = value
+            elif existing is not _AMBIGUOUS and existing != value:
+                self.keys[(scope, level, key)] = _AMBIGUOUS
+        sound = phonetic(keys[0])
+        existing = self.sounds.get(sound)
+        if existing is None:
+            self.sounds[sound] = keys[0]
+        elif existing != keys[0]:
+            self.sounds[sound] = _AMBIGUOUS
+
+    def lookup(self, label, scope=None, by_sound=True):
+        """Returns the value for the closest match to label, or None
+
+        by_sound: False to only match labels that have the same words
+        """
+        keys = fuzzy_keys(label)
+        for (level, key) in enumerate(keys):
+            value = self.keys.get((scope, level, key))
+            if value is _AMBIGUOUS:
+                return None
+            if value is not None:
+                return value
+        if not keys or not by_sound:
+            return None
+        compact = self.sounds.get(phonetic(keys[0]))
+        if compact is None or compact is _AMBIGUOUS:
+            return None
+        value = self.keys.get((scope, 0, compact))
+        return None if value is _AMBIGUOUS else value
+
+__all__ = ["FuzzyIndex", "fuzzy_keys", "label_words", "phonetic"]
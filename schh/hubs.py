@@ -0,0 +1,108 @@
+"""Provides HubRouter for using several Harmony Hubs, one for each room"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+def merge_vocabularies(vocabularies):
+    """Merges dicts of slot name to values into one, keeping each value
+    once, in order of first appearance"""
+    merged = {}
+    for vocabulary in vocabularies:
+        for (slot, values) in vocabulary.items():
+            merged.setdefault(slot, {}).update(dict.fromkeys(values))
+    return dict([(slot, list(values)) for (slot, values) in merged.items()])
+
+class HubRouter:
+    """Picks the Harmony Hub for each Snips site, and handles intents for
+    different hubs on different threads, so a slow hub doesn't hold up
+    intents for the others.  Each hub keeps its own connection, scheduler
+    and cached configuration; the ASR gets the vocabulary of all of them"""
+    def __init__(self, names, sites=None, default=None):
+        """Initialize members
+
+        names: The names of the hubs, in the order they're configured
+        sites: dict of site ID to the name of the hub for that site
+        default: Name of the hub for sites not in sites, or None for the
+        first
+        """
+        self.names = list(names)
+        self.sites = sites if sites is not None else {}
+        self.default = default if default else self.names[0]
+        if self.default not in self.names:
+            raise ValueError("Unknown default Harmony Hub: " + self.default)
+        self.hubs = {}
+        self.lock = Lock()
+        self.executors = {}
+
+    def add(self, name, hub):
+        """Adds the SmartCommandsHarmonyHub for the named hub"""
+        self.hubs[name] = hub
+
+    def name_for_site(self, site_id):
+        """Returns the name of the hub for site_id"""
+        return self.sites.get(site_id, self.default)
+
+    def for_site(self, site_id):
+        """Returns the SmartCommandsHarmonyHub for site_id"""
+        return self.hubs[self.name_for_site(site_id)]
+
+    def dispatch(self, site_id, function, *args):
+        """Calls function with args on the thread for site_id's hub, where
+        calls for the same hub are made in order; with only one hub, it's
+        called straight away on this thread"""
+        if len(self.names) < 2:
+            function(*args)
+            return
+        name = self.name_for_site(site_id)
+        with self.lock:
+            executor = self.executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1)
+                self.executors[name] = executor
+        executor.submit(self._call, function, args)
+
+    def _call(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            print("Caught exception while handling intent!")
+            print(e)
+
+    def get_vocabulary(self, refresh=True):
+        """Returns the activity and command names of every hub, by slot,
+        or None if no hub's configuration could be downloaded; the hubs
+        are asked at the same time"""
+        hubs = list(self.hubs.values())
+        if len(hubs) == 1:
+            return hubs[0].get_vocabulary(refresh)
+        with ThreadPoolExecutor(max_workers=len(hubs)) as executor:
+            vocabularies = list(executor.map(lambda hub: hub.get_vocabulary(refresh), hubs))
+        vocabularies = [vocabulary for vocabulary in vocabularies if vocabulary]
+        if not vocabularies:
+            return None
+        return merge_vocabularies(vocabularies)
+
+    def add_config_listener(self, listener):
+        """Calls listener each time any hub's configuration changes"""
+        for hub in self.hubs.values():
+            hub.add_config_listener(listener)
+
+    def health(self):
+        """Returns a dict of hub name to a dict describing its connection"""
+        return dict([(name, hub.health()) for (name, hub) in self.hubs.items()])
+
+    def save(self):
+        """Saves what every hub has learned that hasn't been saved yet"""
+        for hub in self.hubs.values():
+            hub.save()
+
+    def close(self):
+        """Closes every hub, once the intents for it have been handled"""
+        with self.lock:
+            executors = list(self.executors.values())
+            self.executors = {}
+        for executor in executors:
+            executor.shutdown()
+        for hub in self.hubs.values():
+            hub.close()
+
+__all__ = ["HubRouter", "merge_vocabularies"]
@@ -0,0 +1,155 @@
+"""Provides in-memory caches of Harmony Hub state"""
+from threading import Lock
+from time import monotonic
+
+from schh.fuzzy import FuzzyIndex
+
+class HubConfigCache:
+    """Holds the Harmony Hub's configuration between requests, so it only
+    needs to be downloaded again after the hub reports a change, or after
+    it has been held for longer than ttl seconds"""
+    def __init__(self, ttl=0):
+        """Initialize members
+
+        ttl: Seconds before the cached configuration must be downloaded
+        again, or 0 to keep it until it is invalidated
+        """
+        self.ttl = ttl
+        self.config = None
+        self.version = 0
+        self.updated = 0
+        self.valid = False
+        self.activity_labels = []
+        self.activity_ids = {}
+        self.activity_names = {}
+        self.activity_index = FuzzyIndex()
+        self.restored = False
+        self.listeners = []
+
+    def _set_config(self, config):
+        activity_labels = []
+        activity_ids = {}
+        activity_names = {}
+        for activity in config["activity"]:
+            activity_labels.append(activity["label"])
+            activity_ids[activity["label"].lower()] = activity["id"]
+            activity_names[int(activity["id"])] = activity["label"]
+
+        self.config = config
+        self.activity_labels = activity_labels
+        self.activity_ids = activity_ids
+        self.activity_names = activity_names
+        self.activity_index = FuzzyIndex([(None, activity["label"], activity["id"])
+                for activity in config["activity"]])
+        self.version += 1
+
+    def update(self, config):
+        """Replaces the cached configuration"""
+        self._set_config(config)
+        self.updated = monotonic()
+        self.valid = True
+        self.restored = False
+        for listener in self.listeners:
+            try:
+                listener(self.version)
+            except Exception as e:
+                print("Caught exception in configuration listener!")
+                print(e)
+
+    def restore(self, config):
+        """Loads a configuration saved earlier, e.g. in a Snapshot; it is
+        used until one has been downloaded from the hub, but is stale"""
+        self._set_config(config)
+        self.valid = False
+        self.restored = True
+
+    def invalidate(self):
+        """Marks the cached configuration as out of date; it is still
+        used until a new one has been downloaded"""
+        self.valid = False
+
+    def is_stale(self):
+        """Returns True if the configuration must be downloaded"""
+        if self.config is None or not self.valid:
+            return True
+        return self.ttl > 0 and monotonic() - self.updated > self.ttl
+
+    def list_activities(self):
+        """Returns a list of activity labels"""
+        return list(self.activity_labels)
+
+    def get_activity_id(self, activity_name):
+        """Returns the ID for the named activity, or failing that the
+        closest match to the name, or None"""
+        activity_id = self.activity_ids.get(activity_name.lower())
+        if activity_id is None:
+            activity_id = self.activity_index.lookup(activity_name)
+        return activity_id
+
+    def get_activity_name(self, activity_id):
+        """Returns the name of the activity with the given ID, or None"""
+        return self.activity_names.get(int(activity_id))
+
+class ActivityState:
+    """Tracks the Harmony Hub's current activity from the notifications it
+    pushes, so it can be read without asking the hub"""
+    def __init__(self):
+        self.lock = Lock()
+        self.activity_id = -1
+        self.activity_name = "Power Off"
+        self.starting_id = None
+        self.starting_name = None
+        self.updated = 0
+        self.valid = False
+
+    def set_current(self, activity_id, activity_name):
+        """Records that the hub has finished switching to an activity"""
+        with self.lock:
+            self.activity_id = int(activity_id)
+            if activity_name is not None:
+                self.activity_name = activity_name
+            self.starting_id = None
+            self.starting_name = None
+            self.updated = monotonic()
+            self.valid = True
+
+    def set_starting(self, activity_id, activity_name):
+        """Records that the hub has begun switching to an activity"""
+        with self.lock:
+            self.starting_id = int(activity_id)
+            self.starting_name = activity_name
+            self.updated = monotonic()
+
+    def invalidate(self):
+        """Marks the state as unknown, e.g. when notifications can no
+        longer be received"""
+        with self.lock:
+            self.valid = False
+            self.starting_id = None
+            self.starting_name = None
+
+    def reset(self):
+        """Resets the state to its defaults"""
+        with self.lock:
+            self.activity_id = -1
+            self.activity_name = "Power Off"
+            self.starting_id = None
+            self.starting_name = None
+            self.updated = 0
+            self.valid = False
+
+    def current(self):
+        """Returns the ID and name of the current activity"""
+        with self.lock:
+            return (self.activity_id, self.activity_name)
+
+    def is_current_or_starting(self, activity_name):
+        """Returns True if the named activity is current or being started;
+        names are matched regardless of case"""
+        activity_name = activity_name.lower()
+        with self.lock:
+            if self.activity_name.lower() == activity_name:
+                return True
+            return self.starting_name is not None and self.starting_name.lower() == activity_name
+
+__all__ = ["ActivityState", "HubConfigCache"]
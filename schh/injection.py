@@ -0,0 +1,79 @@
+"""Provides InjectionTracker for injecting only what the ASR doesn't have yet"""
+import hashlib
+from threading import Lock
+
+from hermes_python.ontology.injection import (InjectionRequestMessage,
+        AddFromVanillaInjectionRequest, AddInjectionRequest)
+
+# Slots the skill injects values into
+ACTIVITIES_SLOT = "harmony_hub_activities_name"
+COMMANDS_SLOT = "harmony_hub_command"
+
+def fingerprint(vocabulary):
+    """Returns a digest of a dict of slot name to values, that doesn't
+    depend on the order of either"""
+    digest = hashlib.sha1()
+    for slot in sorted(vocabulary):
+        digest.update(slot.encode("utf-8") + b"\0")
+        for value in sorted(set(vocabulary[slot])):
+            digest.update(value.encode("utf-8") + b"\0")
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+class InjectionTracker:
+    """Remembers what has been injected into the ASR, so that only values
+    it hasn't seen are injected again.  Every injection makes the ASR
+    recompile, so the first injection replaces everything, and after that
+    only additions are sent; values that disappear stay injected, since
+    removing them would need a full injection"""
+    def __init__(self, injected=None, fingerprint=None):
+        """Initialize members
+
+        injected: dict of slot name to the set of values already injected,
+        e.g. from a Snapshot, or None if nothing is known to be
+        fingerprint: The fingerprint of the vocabulary last injected
+        """
+        self.lock = Lock()
+        self.injected = injected
+        self.fingerprint = fingerprint
+
+    def get_payload(self, vocabulary):
+        """Returns the InjectionRequestMessage needed to bring the ASR up to
+        date with vocabulary, a dict of slot name to values, or None if it
+        already is"""
+        if fingerprint(vocabulary) == self.fingerprint:
+            return None
+        if self.injected is None:
+            return InjectionRequestMessage([AddFromVanillaInjectionRequest(
+                dict([(slot, sorted(set(values))) for (slot, values) in vocabulary.items()]))])
+
+        added = {}
+        for (slot, values) in vocabulary.items():
+            new_values = set(values) - self.injected.get(slot, frozenset())
+            if new_values:
+                added[slot] = sorted(new_values)
+        if not added:
+            return None
+        return InjectionRequestMessage([AddInjectionRequest(added)])
+
+    def record(self, vocabulary):
+        """Records that vocabulary has been injected"""
+        injected = dict(self.injected or {})
+        for (slot, values) in vocabulary.items():
+            injected[slot] = injected.get(slot, frozenset()).union(values)
+        self.injected = injected
+        self.fingerprint = fingerprint(vocabulary)
+
+    def inject(self, vocabulary, request_injection):
+        """Passes whatever the ASR is missing from vocabulary to
+        request_injection; returns True if anything was injected"""
+        with self.lock:
+            payload = self.get_payload(vocabulary)
+            if payload is None:
+                self.fingerprint = fingerprint(vocabulary)
+                return False
+            request_injection(payload)
+            self.record(vocabulary)
+            return True
+
+__all__ = ["ACTIVITIES_SLOT", "COMMANDS_SLOT", "InjectionTracker", "fingerprint"]
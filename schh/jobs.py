@@ -0,0 +1,99 @@
+"""Provides JobRunner for running long command sequences in the background"""
+from threading import Event, Lock, Thread
+from time import monotonic
+
+class Job:
+    """A step repeated a number of times, with a delay between each"""
+    def __init__(self, name, step, count, delay, first_delay=0):
+        """Initialize members
+
+        name: What the job is, for reporting its status
+        step: Function to call for each step; it returns 1 on success,
+        and anything else stops the job
+        count: How many times to call step
+        delay: Seconds to wait between steps
+        first_delay: Seconds to wait before the first step
+        """
+        self.name = name
+        self.step = step
+        self.count = count
+        self.delay = delay
+        self.first_delay = first_delay
+        self.done = 0
+        self.state = "queued"
+        self.result = None
+        self.started = None
+        self.cancelled = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        self.state = "running"
+        self.started = monotonic()
+        for idx in range(self.count):
+            if self.cancelled.wait(self.delay if idx > 0 else self.first_delay):
+                break
+            self.result = self.step()
+            if self.result != 1:
+                self.state = "failed"
+                return
+            self.done += 1
+        if self.cancelled.is_set():
+            self.state = "cancelled"
+        else:
+            self.state = "finished"
+
+    def cancel(self):
+        """Stops the job before its next step"""
+        self.cancelled.set()
+
+    def is_active(self):
+        """Returns True if the job has not stopped yet"""
+        return self.state in ("queued", "running")
+
+    def status(self):
+        """Returns a dict describing the job"""
+        return {
+            "name": self.name,
+            "state": self.state,
+            "done": self.done,
+            "count": self.count,
+            "result": self.result,
+            "elapsed": 0 if self.started is None else monotonic() - self.started,
+        }
+
+class JobRunner:
+    """Runs one background job at a time; starting a new job, or
+    cancelling, stops the one that's running"""
+    def __init__(self):
+        """Initialize members"""
+        self.lock = Lock()
+        self.job = None
+
+    def start(self, name, step, count, delay, first_delay=0):
+        """Starts a Job in the background and returns it"""
+        job = Job(name, step, count, delay, first_delay)
+        with self.lock:
+            if self.job is not None:
+                self.job.cancel()
+            self.job = job
+        job.thread.start()
+        return job
+
+    def cancel(self):
+        """Stops the running job; returns True if there was one"""
+        with self.lock:
+            job = self.job
+        if job is None or not job.is_active():
+            return False
+        job.cancel()
+        return True
+
+    def status(self):
+        """Returns the status of the most recent job, or None"""
+        with self.lock:
+            job = self.job
+        if job is None:
+            return None
+        return job.status()
+
+__all__ = ["Job", "JobRunner"]
@@ -0,0 +1,197 @@
+"""Provides Metrics for recording how long the skill and the hub take"""
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+from threading import Lock, Thread
+from time import monotonic
+
+# Upper bounds in seconds of the histogram buckets, as Prometheus uses
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text for the metrics the skill records
+HELP = {
+    "schh_intent_seconds": "Time to handle an intent, end to end",
+    "schh_intent_phase_seconds": "Time spent in each phase of handling an intent",
+    "schh_hub_operation_seconds": "Time taken by each public Harmony Hub operation",
+    "schh_hub_phase_seconds": "Time spent in each phase of talking to the Harmony Hub",
+}
+
+class Histogram:
+    """Counts observations into buckets, Prometheus style"""
+    def __init__(self, buckets=BUCKETS):
+        """Initialize members
+
+        buckets: Sorted upper bounds of the buckets; one for anything
+        larger is added
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds an observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket the given fraction of
+        observations fall within, or None if there are none"""
+        if self.count == 0:
+            return None
+        wanted = fraction * self.count
+        total = 0
+        for (idx, count) in enumerate(self.counts):
+            total += count
+            if total >= wanted:
+                return self.buckets[idx] if idx < len(self.buckets) else float("inf")
+        return float("inf")
+
+class _Timer:
+    """Context manager that records the time its body takes"""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *_):
+        self.metrics.observe(self.name, monotonic() - self.start, **self.labels)
+        return False
+
+class _NullTimer:
+    """Context manager that does nothing, for when metrics are disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def timed(name, **labels):
+    """Decorates a method of an object with a metrics member, recording
+    how long each call takes in the named histogram"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return method(self, *args, **kwargs)
+            with self.metrics.timer(name, **labels):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class Metrics:
+    """In-process histograms of timings, by metric name and labels, which
+    can be exported in the Prometheus text format; when disabled, recording
+    does nothing"""
+    def __init__(self, enabled=False, buckets=BUCKETS):
+        """Initialize members
+
+        enabled: False to record nothing
+        buckets: Upper bounds of the buckets for new histograms
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = Lock()
+        self.histograms = {}
+        self.server = None
+
+    def timer(self, name, **labels):
+        """Returns a context manager that records how long its body takes"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def observe(self, name, seconds, **labels):
+        """Records an observation in the named histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self.histograms[key] = histogram
+            histogram.observe(seconds)
+
+    def get(self, name, **labels):
+        """Returns the named Histogram, or None if nothing was recorded"""
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def export(self):
+        """Returns every histogram in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            keys = sorted(self.histograms)
+            last_name = None
+            for key in keys:
+                (name, labels) = key
+                histogram = self.histograms[key]
+                if name != last_name:
+                    if name in HELP:
+                        lines.append("# HELP %s %s" % (name, HELP[name]))
+                    lines.append("# TYPE %s histogram" % name)
+                    last_name = name
+                total = 0
+                for (idx, count) in enumerate(histogram.counts):
+                    total += count
+                    bound = histogram.buckets[idx] if idx < len(histogram.buckets) else "+Inf"
+                    lines.append("%s_bucket%s %d" % (name, _format_labels(labels, ("le", str(bound))), total))
+                lines.append("%s_sum%s %f" % (name, _format_labels(labels), histogram.sum))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the exported histograms to path"""
+        try:
+            with open(path + ".tmp", "w") as metrics_file:
+                metrics_file.write(self.export())
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("Failed to write metrics to " + path)
+            print(e)
+
+    def serve(self, port, address="127.0.0.1"):
+        """Serves the exported histograms over HTTP on a background thread,
+        for a Prometheus server to scrape"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.export().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self.server = HTTPServer((address, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Stops serving the histograms"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+def _format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra is not None:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (name, str(value).replace('"', '\\"'))
+            for (name, value) in labels]) + "}"
+
+__all__ = ["BUCKETS", "Histogram", "Metrics", "timed"]
@@ -0,0 +1,317 @@
+"""Provides CommandScheduler for serializing traffic to a Harmony Hub"""
+from concurrent.futures import CancelledError, Future, TimeoutError
+import heapq
+import itertools
+from threading import Condition, Thread
+from time import monotonic
+
+from schh.metrics import Metrics
+
+# Priorities; lower numbers run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Returned by CommandScheduler.run when a request was pre-empted by a newer
+# one before it could finish
+PREEMPTED = -5
+
+# Returned by CommandScheduler.run when a request's timeout passed before
+# it finished
+TIMED_OUT = -4
+
+# Commands people expect an immediate response to, as normalized labels
+# with the spaces and underscores removed
+INTERACTIVE_COMMANDS = frozenset([
+    "mute",
+    "pause",
+    "play",
+    "stop",
+    "volumeup",
+    "volumedown",
+])
+
+# Commands that undo each other, as (group, direction) by compact label
+OPPOSING_COMMANDS = {
+    "volumeup": ("volume", 1),
+    "volumedown": ("volume", -1),
+    "channelup": ("channel", 1),
+    "channeldown": ("channel", -1),
+}
+
+def compact_label(command):
+    """Returns command in lower case without spaces or underscores"""
+    return command.lower().replace(" ", "").replace("_", "")
+
+def command_priority(command):
+    """Returns the priority for sending the command with the given label"""
+    if compact_label(command) in INTERACTIVE_COMMANDS:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_NORMAL
+
+def coalesce_key(command):
+    """Returns the key under which sends of command are coalesced; opposing
+    commands share a key"""
+    key = compact_label(command)
+    return OPPOSING_COMMANDS.get(key, (key, 1))[0]
+
+def merge_sends(sends):
+    """Merges a list of (device, command, count, delay) sends, so that each
+    command is sent to each device once with the total count, and opposing
+    commands cancel out; returns the merged list in order of first
+    appearance"""
+    merged = {}
+    for (device, command, count, delay) in sends:
+        (group, direction) = OPPOSING_COMMANDS.get(compact_label(command), (command, 1))
+        key = (device, group)
+        if key not in merged:
+            merged[key] = {"commands": {}, "net": 0, "delay": delay}
+        entry = merged[key]
+        entry["commands"][direction] = command
+        entry["net"] += direction * count
+        entry["delay"] = max(entry["delay"], delay)
+
+    result = []
+    for ((device, _), entry) in merged.items():
+        if entry["net"] > 0:
+            result.append((device, entry["commands"][1], entry["net"], entry["delay"]))
+        elif entry["net"] < 0:
+            result.append((device, entry["commands"][-1], -entry["net"], entry["delay"]))
+    return result
+
+class _Request:
+    """A function waiting to be run by the scheduler"""
+    def __init__(self, function, args, priority, preemptible, item=None, key=None,
+            timeout=None):
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.preemptible = preemptible
+        self.preempted = False
+        self.item = item
+        self.key = key
+        self.queued = monotonic()
+        self.deadline = self.queued + timeout if timeout else None
+        self.future = Future()
+
+class CommandScheduler:
+    """Runs every request for one Harmony Hub, one at a time, on a single
+    thread; higher priority requests go first, and any new request that
+    isn't preemptible itself pre-empts the preemptible ones
+
+    Sends queued with send() are coalesced: everything queued for the same
+    send function is passed to it in one call, and sends for the same
+    coalesce key don't pre-empt each other.  A send is only held for up to
+    coalesce_window seconds, waiting for more, when another send for the
+    same key is already queued behind it, i.e. while they're coming in a
+    burst; on its own, it goes straight away."""
+    def __init__(self, idle=None, idle_interval=None, coalesce_window=0, metrics=None):
+        """Initialize members
+
+        idle: Function to call on the scheduler's thread when it has had
+        nothing to do for idle_interval seconds
+        idle_interval: Seconds between calls to idle
+        coalesce_window: Seconds to hold a send that's part of a burst,
+        while waiting for others to combine with it
+        metrics: Metrics to record how long requests wait in
+        """
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.coalesce_window = coalesce_window
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.condition = Condition()
+        self.requests = []
+        self.sequence = itertools.count()
+        self.current = None
+        self.deadline = None
+        self.running = True
+        self.thread = Thread(target=self._worker_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, priority=PRIORITY_NORMAL, preemptible=False,
+            timeout=None):
+        """Queues function to be called with args; returns a Future for
+        its result
+
+        timeout: Seconds from now that function has to finish in, for
+        time_left()
+        """
+        return self._queue(_Request(function, args, priority, preemptible, timeout=timeout))
+
+    def _queue(self, request):
+        with self.condition:
+            if not request.preemptible:
+                self._preempt(request)
+            heapq.heappush(self.requests, (request.priority, next(self.sequence), request))
+            self.condition.notify()
+        return request.future
+
+    def run(self, function, *args, priority=PRIORITY_NORMAL, preemptible=False,
+            timeout=None):
+        """Calls function with args on the scheduler's thread, and returns
+        its result, PREEMPTED, or TIMED_OUT if it hasn't finished within
+        timeout seconds"""
+        request = _Request(function, args, priority, preemptible, timeout=timeout)
+        self._queue(request)
+        return self._result(request)
+
+    def send(self, send_batch, item, key, priority=PRIORITY_NORMAL, preemptible=False,
+            timeout=None):
+        """Queues item to be passed to send_batch, in a list with any other
+        items coalesced with it; send_batch returns a list of results, one
+        for each item.  Returns the result for item, PREEMPTED, or
+        TIMED_OUT if it hasn't been sent within timeout seconds
+
+        key: Items with the same key don't pre-empt each other
+        """
+        request = _Request(send_batch, (), priority, preemptible, item, key, timeout)
+        self._queue(request)
+        return self._result(request)
+
+    def _result(self, request):
+        timeout = None
+        if request.deadline is not None:
+            timeout = max(request.deadline - monotonic(), 0)
+        try:
+            return request.future.result(timeout)
+        except CancelledError:
+            return PREEMPTED
+        except TimeoutError:
+            # This drops the request if it hasn't started; if it has, the
+            # function running it gives up at the same time (see time_left)
+            request.future.cancel()
+            return TIMED_OUT
+
+    def is_preempted(self):
+        """Returns True if the request being run should stop early; for
+        use by functions that send several commands"""
+        current = self.current
+        return current is not None and current.preempted
+
+    def time_left(self):
+        """Returns the seconds left before the caller of the request being
+        run gives up on it, or None if it has no timeout; for use by the
+        functions the scheduler runs"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0)
+
+    def _preempt(self, request):
+        """Cancels queued preemptible requests and flags a running one,
+        unless they will be coalesced with request; the caller must hold
+        self.condition"""
+        def preempts(other):
+            return other.preemptible and (request.key is None or other.key != request.key)
+
+        if self.current is not None and preempts(self.current):
+            self.current.preempted = True
+        remaining = []
+        for item in self.requests:
+            if preempts(item[2]):
+                item[2].future.cancel()
+            else:
+                remaining.append(item)
+        if len(remaining) != len(self.requests):
+            heapq.heapify(remaining)
+            self.requests = remaining
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                if self.running and not self.requests:
+                    self.condition.wait(self.idle_interval)
+                if not self.running:
+                    break
+                if not self.requests:
+                    request = None
+                else:
+                    request = heapq.heappop(self.requests)[2]
+                    self.current = request
+                    if request.item is not None:
+                        batch = self._gather(request)
+
+            if request is None:
+                if self.idle is not None:
+                    self._call_idle()
+                continue
+
+            if self.metrics.enabled:
+                self._record_waits(batch if request.item is not None else [request])
+            if request.item is not None:
+                self._run_batch(request.function, batch)
+            elif request.future.set_running_or_notify_cancel():
+                self.deadline = request.deadline
+                try:
+                    request.future.set_result(request.function(*request.args))
+                except Exception as e:
+                    request.future.set_exception(e)
+            with self.condition:
+                self.current = None
+                self.deadline = None
+
+    def _gather(self, request):
+        """Waits out the coalescing window if another send for the same key
+        is queued, then takes every queued send for the same send function;
+        the caller must hold self.condition"""
+        if any([item[2].item is not None and item[2].key == request.key
+                for item in self.requests]):
+            deadline = request.queued + self.coalesce_window
+            remaining = deadline - monotonic()
+            while self.running and remaining > 0:
+                self.condition.wait(remaining)
+                remaining = deadline - monotonic()
+
+        batch = [request]
+        others = []
+        for item in self.requests:
+            if item[2].item is not None and item[2].function == request.function:
+                batch.append(item[2])
+            else:
+                others.append(item)
+        if len(batch) > 1:
+            heapq.heapify(others)
+            self.requests = others
+            batch.sort(key=lambda other: other.queued)
+        return batch
+
+    def _record_waits(self, requests):
+        now = monotonic()
+        for request in requests:
+            self.metrics.observe("schh_hub_phase_seconds", now - request.queued, phase="queue_wait")
+
+    def _run_batch(self, send_batch, batch):
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        # The batch has to be sent before the first of its callers gives up
+        deadlines = [request.deadline for request in batch if request.deadline is not None]
+        self.deadline = min(deadlines) if deadlines else None
+        try:
+            results = send_batch([request.item for request in batch])
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for (request, result) in zip(batch, results):
+            request.future.set_result(result)
+
+    def _call_idle(self):
+        try:
+            self.idle()
+        except Exception as e:
+            print("Caught exception while idle!")
+            print(e)
+
+    def close(self):
+        """Cancels anything queued and stops the scheduler's thread once the
+        running request has finished"""
+        with self.condition:
+            self.running = False
+            for item in self.requests:
+                item[2].future.cancel()
+            self.requests = []
+            self.condition.notify()
+        self.thread.join()
+
+__all__ = ["CommandScheduler", "PREEMPTED", "PRIORITY_BULK", "PRIORITY_INTERACTIVE",
+        "PRIORITY_NORMAL", "TIMED_OUT", "coalesce_key", "command_priority", "merge_sends"]
@@ -1,225 +1,135 @@
 """Provides SmartCommandsHarmonyHub for smarter interaction with a HarmonyHub"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+
 from pyharmony import client as harmony_client
-from hermes_python.ontology.injection import (InjectionRequestMessage, AddFromVanillaInjectionRequest)
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import MatchXPath
+
+from schh.core import HarmonyHubCore, SendFailed
+
+class XmppHarmonyDriver:
+    """Talks to a Harmony Hub over pyharmony's XMPP session.  pyharmony
+    blocks, so each session gets an executor with a single thread that
+    makes all of its calls, in order, leaving the event loop free.
 
-class SmartCommandsHarmonyHub:
-    """Class for interacting with a Harmony Hub in a smarter way"""
-    def __init__(self, remote_address):
+    pyharmony sends each press without waiting for the hub's answer, so a
+    press the hub drops goes unnoticed, and nothing can be learned about
+    a device's delay from it.  The delay is passed to pyharmony as how
+    long to hold each press, which also spaces out the repeats"""
+    channel_separator = "."
+    reports_rejects = False
+
+    def __init__(self, remote_address, listener, loop):
         """Initialize members
 
         remote_address: The host name or IP address of the Harmony Hub
+        listener: The HarmonyHubCore to pass the hub's notifications to
+        loop: The event loop the driver's coroutines run on
         """
         self.remote_address = remote_address
-        self.config = None
-        self.activity_id = -1
-        self.activity_name = "Power Off"
-        self.command_map = {}
-        if self._connect():
-            self.harmony.disconnect()
-
-    def _reset_state_info(self):
-        """Resets state-related members to their defaults"""
-        self.config = None
-        self.activity_id = -1
-        self.activity_name = "Power Off"
-
-    def _close(self):
-        """Closes the connectoion to the Harmony Hub"""
-        self.harmony.disconnect()
-        self._reset_state_info()
-
-    def _connect(self):
-        """Connects to the Harmony Hub"""
+        self.listener = listener
+        self.loop = loop
+        self.harmony = None
+        self.executor = None
+        self.config_version = None
+
+    def _call(self, function, *args):
+        """Returns a future for calling function with args on the session's
+        thread"""
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    async def connect(self, subscribe):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.harmony = await self._call(harmony_client.create_and_connect_client,
+                self.remote_address, 5222)
+        if not self.harmony:
+            self.harmony = None
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            return False
+        if subscribe:
+            self._subscribe_notifications()
+        return True
+
+    async def close(self, clean=True):
+        harmony = self.harmony
+        executor = self.executor
+        self.harmony = None
+        self.executor = None
+        if harmony:
+            if clean:
+                await self.loop.run_in_executor(executor, harmony.disconnect)
+            else:
+                # The session's thread may be stuck waiting for the hub, so
+                # abandon it rather than wait in line behind it
+                await self.loop.run_in_executor(None, partial(harmony.disconnect, send_close=False))
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    async def fetch_config(self, fresh=False):
+        return await self._call(self.harmony.get_config)
+
+    async def get_current_activity(self):
+        return await self._call(self.harmony.get_current_activity)
+
+    async def start_activity(self, activity_id):
+        return bool(await self._call(self.harmony.start_activity, activity_id))
+
+    def _send_all(self, harmony, sends, should_stop):
+        """Runs on the session's thread; presses each button in turn"""
+        for send in sends:
+            (device, command, count, delay) = send
+            try:
+                for _ in range(count):
+                    if should_stop():
+                        return set()
+                    harmony.send_command(device, command, delay)
+            except Exception as e:
+                raise SendFailed(send, e)
+        return set()
+
+    async def send_commands(self, sends, should_stop):
+        return await self._call(self._send_all, self.harmony, sends, should_stop)
+
+    async def change_channel(self, channel):
+        return bool(await self._call(self.harmony.change_channel, channel))
+
+    def _subscribe_notifications(self):
+        """Asks the XMPP client to pass us the state notifications the
+        Harmony Hub pushes to an open session"""
+        self.harmony.register_handler(
+                Callback("Harmony Hub notification",
+                    MatchXPath("{%s}message/{connect.logitech.com}event" % self.harmony.default_ns),
+                    self._on_notification))
+
+    def _on_notification(self, message):
+        """Called on the XMPP client's thread for each notification"""
+        event = message.xml.find("{connect.logitech.com}event")
+        if event is None or not event.text or "stateDigest" not in event.get("type", ""):
+            return
         try:
-            self.harmony = harmony_client.create_and_connect_client(self.remote_address, 5222)
-            if not self.harmony:
-                self.harmony = None
-                print("Failed to connect to Harmony Hub: " + self.remote_address)
-                print("Try using the IP address instead of hostname")
-                return False
-            self.config = self.harmony.get_config()
-            self.activity_id = self.harmony.get_current_activity()
-            activity = [x for x in self.config["activity"] if int(x["id"]) == self.activity_id][0]
-            if type(activity) is dict:
-                self.activity_name = activity["label"]
-            return True
-        except Error as e:
-            print("Caught exception while connecting to Harmony Hub!")
-            print(e)
-        return False
-
-    def _get_channel_separator(self):
-        return "."
-
-    def _get_commands_payload(self, commands):
-        return AddFromVanillaInjectionRequest({"harmony_hub_command": commands})
-
-    def _get_activities_payload(self, activities):
-        return AddFromVanillaInjectionRequest({"harmony_hub_activities_name": activities})
-
-    def _get_update_payload(self):
-        """ Finds all the commands and returns a payload for injecting
-        commands """
-        operations = []
-        activities = []
-        commands = []
-        self.command_map = {}
-        for activity in self.config["activity"]:
-            activities.append(activity["label"])
-            for cgroups in activity["controlGroup"]:
-                for fncn in cgroups["function"]:
-                    (label_key, voice_command) = self._label_to_key_and_voice_command(fncn["label"], activity["id"])
-                    commands.append(voice_command)
-                    self.command_map[label_key] = {}
-                    # Initialize command to fncn["name"], in case we
-                    # can't find better
-                    self.command_map[label_key]["command"] = fncn["name"]
-                    # Find better...
-                    idx = fncn["action"].find("command")
-                    if idx != -1:
-                        idx += 10
-                        ridx = fncn["action"].find("\"", idx)
-                        if ridx != -1:
-                            self.command_map[label_key]["command"] = fncn["action"][idx:ridx]
-                    # Next, find the device to use
-                    ridx = fncn["action"].rfind("\"")
-                    idx = fncn["action"].find("deviceId")
-                    if idx == -1:
-                        idx = ridx - 8
-                    else:
-                        idx += 11
-                    self.command_map[label_key]["device"] = fncn["action"][idx:ridx]
-
-        operations.append(self._get_activities_payload(activities))
-        operations.append(self._get_commands_payload(list(set(commands))))
-        return InjectionRequestMessage(operations)
-
-    def _label_to_key_and_voice_command(self, label, activity):
-        """ Return the key for command_map for the given label and activity"""
-        if label == "0":
-            label = "zero"
-        elif label == "1":
-            label = "one"
-        elif label == "2":
-            label = "two"
-        elif label == "3":
-            label = "three"
-        elif label == "4":
-            label = "four"
-        elif label == "5":
-            label = "five"
-        elif label == "6":
-            label = "six"
-        elif label == "7":
-            label = "seven"
-        elif label == "8":
-            label = "eight"
-        elif label == "9":
-            label = "nine"
-
-        voice_command = label
-        return (activity + "_" + label.lower().replace(" ", "_"), voice_command)
-
-    def _map_command(self, command):
-        """Maps from a command label to a command"""
-        label_key = self._label_to_key_and_voice_command(command, str(self.activity_id))[0]
-        if label_key in self.command_map.keys():
-            return self.command_map[label_key]
-        return None
-
-    def change_channel(self, channel_slot):
-        """Changes to the specified channel, being sure that if digital
-        channels are used, that it uses the correct separator style.
-        """
-        which_channel = ""
-        dot_reached = False
-        sub_channel = 0
-        for idx in range(len(channel_slot)):
-            if channel_slot[idx].isdigit() and not dot_reached:
-                which_channel += channel_slot[idx]
-            elif channel_slot[idx] == "." or channel_slot[idx] == ",":
-                which_channel += self._get_channel_separator()
-                dot_reached = True
-                idx += 1
-                break
-
-        if dot_reached:
-            if len(channel_slot) > idx:
-                sub_channel = int(channel_slot[idx])
-                if len(channel_slot) > idx+1 and int(channel_slot[idx+1]) >= 5:
-                    sub_channel += 1
-                which_channel += str(sub_channel)
-
-        if not self._connect():
-            return -1
-        ret_value = self.harmony.change_channel(which_channel)
-        self._close()
-        return 1 if ret_value else 0
-
-    def send_command(self, command, repeat, delay=0.1):
-        """Sends command to the Harmony Hub repeat times"""
-        if not self._connect():
-            return -1
-        mapped_command = self._map_command(command)
-        if mapped_command is None:
-            return 0
-        for _ in range(repeat):
-            self.harmony.send_command(mapped_command["device"], mapped_command["command"], delay)
-        self._close()
-        return 1
-
-    def list_activities(self):
-        """Returns a list of activities"""
-        if not self._connect():
-            return -1
-
-        activities = []
-        for x in self.config["activity"]:
-            activities.append(x["label"])
-
-        self._close()
-        return activities
-
-    def current_activity(self):
-        """Returns the ID and name of the current activity"""
-        if not self._connect():
-            return -1
-        return_values = (self.activity_id, self.activity_name)
-        self._close()
-        return return_values
-
-    def start_activity(self, activity_name):
-        """Starts an activity on the Harmony Hub"""
-        if not self._connect():
-            return -1
-        if activity_name == self.activity_name:
-            print("current activity is the same as what was requested, doing nothing")
-            return -2
-
-        activities = [x for x in self.config["activity"] if x["label"] == activity_name]
-        if not activities:
-            print("Cannot find the activity: {} ".format(activity_name))
-            return -3
-        activity = activities[0]
-
-        if type(activity) is dict:
-            activity_id = activity["id"]
-        return_value = self.harmony.start_activity(activity_id)
-        self._close()
-        return 1 if return_value else 0
-
-    def power_off(self):
-        """Sets the current activity of the Harmony Hub to -1, AKA "PowerOff"."""
-        return self.start_activity("PowerOff")
-
-    def get_injection_payload(self):
-        """Injects the list of activities known to the Harmony Hub"""
-        if not self._connect():
-            return None 
-        return self._get_update_payload()
-
-    def close(self):
-        self._close()
-        return
-
-__all__ = ["SmartCommandsHarmonyHub"]
+            state = json.loads(event.text)
+        except ValueError:
+            return
+        config_version = state.get("configVersion")
+        if config_version is not None:
+            if self.config_version is not None and config_version != self.config_version:
+                self.listener.on_config_changed()
+            self.config_version = config_version
+
+        activity_id = state.get("activityId")
+        if activity_id is not None:
+            activity_status = state.get("activityStatus")
+            if activity_status == 1:
+                self.listener.on_activity(activity_id, starting=True)
+            elif activity_status in (0, 2):
+                self.listener.on_activity(activity_id)
+
+class SmartCommandsHarmonyHub(HarmonyHubCore):
+    """Class for interacting with a Harmony Hub in a smarter way, using
+    pyharmony"""
+    driver_class = XmppHarmonyDriver
+
+__all__ = ["SmartCommandsHarmonyHub", "XmppHarmonyDriver"]
@@ -0,0 +1,237 @@
+"""Provides SimulatedHub for running the skill without a Harmony Hub"""
+import asyncio
+from collections import namedtuple
+import json
+import random
+from threading import Lock
+from time import sleep
+
+# What aioharmony's send_commands returns for each command the hub rejected
+SimulatedSendResponse = namedtuple("SimulatedSendResponse", ["command", "code", "msg"])
+
+# Labels of the functions every simulated device has, before any numbered
+# ones are added to reach the requested count
+COMMON_FUNCTIONS = ["Volume Up", "Volume Down", "Mute", "Channel Up",
+        "Channel Down", "Pause", "Play", "Stop", "0", "1", "2", "3", "4", "5",
+        "6", "7", "8", "9"]
+
+def make_config(activities=5, devices=10, functions=40, seed=0):
+    """Returns a Harmony Hub configuration with the given number of
+    activities, devices and functions per device; the same arguments always
+    give the same configuration"""
+    rand = random.Random(seed)
+    labels = COMMON_FUNCTIONS[:functions]
+    labels += ["Function %d" % idx for idx in range(len(labels), functions)]
+
+    def function(label, device_id):
+        command = label.replace(" ", "")
+        return {
+            "label": label,
+            "name": command,
+            "action": json.dumps({"command": command, "type": "IRCommand",
+                "deviceId": device_id}, separators=(",", ":")),
+        }
+
+    device_list = []
+    for idx in range(devices):
+        device_id = str(10000000 + idx)
+        device_list.append({
+            "id": device_id,
+            "label": "Device %d" % idx,
+            "controlGroup": [{"name": "All",
+                "function": [function(label, device_id) for label in labels]}],
+        })
+
+    activity_list = [{"id": "-1", "label": "PowerOff", "controlGroup": []}]
+    for idx in range(activities):
+        # Each activity uses a handful of devices, and offers all of their
+        # functions, as the hub does for its default control groups
+        used = rand.sample(device_list, min(len(device_list), 3))
+        activity_list.append({
+            "id": str(20000000 + idx),
+            "label": "Activity %d" % idx,
+            "controlGroup": [{"name": device["label"],
+                "function": device["controlGroup"][0]["function"]} for device in used],
+        })
+    return {"activity": activity_list, "device": device_list}
+
+class SimulatedHub:
+    """Stands in for a Harmony Hub at the point where the skill's backends
+    call aioharmony and pyharmony, with configurable latency and dropped
+    requests, and counts what it's asked to do; install() makes both
+    backends use it"""
+    def __init__(self, config=None, latency=0.0, jitter=0.0, drop_rate=0.0, seed=0):
+        """Initialize members
+
+        config: The configuration to serve, e.g. from make_config()
+        latency: Seconds each request to the hub takes
+        jitter: Up to this many more seconds are added to each request, at
+        random
+        drop_rate: Fraction of requests that get no answer
+        seed: Seed for the random jitter and drops
+        """
+        self.config = config if config is not None else make_config()
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.activity_id = -1
+        self.counts = {}
+
+    def _count(self, request):
+        with self.lock:
+            self.counts[request] = self.counts.get(request, 0) + 1
+
+    def _delay(self):
+        """Returns how long the next request takes, or None if it's dropped"""
+        with self.lock:
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                return None
+            return self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+
+    def get_activity_name(self, activity_id):
+        """Returns the label of the activity with the given ID"""
+        for activity in self.config["activity"]:
+            if int(activity["id"]) == int(activity_id):
+                return activity["label"]
+        return None
+
+    def request(self, name):
+        """Simulates a request to the hub; returns False if it was dropped"""
+        self._count(name)
+        delay = self._delay()
+        if delay is None:
+            sleep(self.latency + self.jitter)
+            return False
+        if delay:
+            sleep(delay)
+        return True
+
+    async def request_async(self, name):
+        """Simulates a request to the hub from an event loop; returns False
+        if it was dropped"""
+        self._count(name)
+        delay = self._delay()
+        if delay is None:
+            await asyncio.sleep(self.latency + self.jitter)
+            return False
+        if delay:
+            await asyncio.sleep(delay)
+        return True
+
+    def create_and_connect_client(self, ip_address, port):
+        """Stands in for pyharmony.client.create_and_connect_client"""
+        if not self.request("connect"):
+            return False
+        return SimulatedXmppClient(self)
+
+    def create_api(self, ip_address, protocol=None, loop=None):
+        """Stands in for aioharmony.harmonyapi.HarmonyAPI"""
+        return SimulatedHarmonyAPI(self)
+
+    def install(self):
+        """Makes any backend that has been imported talk to this hub"""
+        try:
+            import schh.schhaio
+            schh.schhaio.HarmonyAPI = self.create_api
+        except ImportError:
+            pass
+        try:
+            import schh.schh
+            schh.schh.harmony_client = self
+        except ImportError:
+            pass
+
+class SimulatedXmppClient:
+    """The parts of pyharmony's HarmonyClient the skill uses"""
+    default_ns = "jabber:client"
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.handlers = []
+
+    def _request(self, name):
+        if not self.hub.request(name):
+            raise TimeoutError("Simulated Harmony Hub dropped " + name)
+
+    def get_config(self):
+        self._request("get_config")
+        return self.hub.config
+
+    def get_current_activity(self):
+        self._request("get_current_activity")
+        return self.hub.activity_id
+
+    def start_activity(self, activity_id):
+        self._request("start_activity")
+        self.hub.activity_id = int(activity_id)
+        return True
+
+    def send_command(self, device, command, delay=0):
+        self._request("send_command")
+        if delay:
+            sleep(delay)
+
+    def change_channel(self, channel):
+        self._request("change_channel")
+        return True
+
+    def register_handler(self, handler):
+        self.handlers.append(handler)
+
+    def disconnect(self, wait=False, send_close=True):
+        self.hub._count("disconnect")
+
+class _SimulatedHarmonyClient:
+    """The part of aioharmony's HarmonyClient the skill calls directly"""
+    def __init__(self, hub):
+        self.hub = hub
+
+    async def send_to_hub(self, command, params=None, **_):
+        if not await self.hub.request_async(command):
+            return None
+        return {"code": 200, "msg": "OK"}
+
+    async def refresh_info_from_hub(self):
+        await self.hub.request_async("get_config")
+
+class SimulatedHarmonyAPI:
+    """The parts of aioharmony's HarmonyAPI the skill uses"""
+    def __init__(self, hub):
+        self.hub = hub
+        self.callbacks = None
+        self._harmony_client = _SimulatedHarmonyClient(hub)
+
+    @property
+    def hub_config(self):
+        return (self.hub.config, {}, {}, [], [])
+
+    @property
+    def current_activity(self):
+        return (self.hub.activity_id, self.hub.get_activity_name(self.hub.activity_id))
+
+    async def connect(self):
+        return await self.hub.request_async("connect")
+
+    async def close(self):
+        self.hub._count("disconnect")
+
+    async def start_activity(self, activity_id):
+        if not await self.hub.request_async("start_activity"):
+            return (False, "Timeout")
+        self.hub.activity_id = int(activity_id)
+        if self.callbacks is not None and self.callbacks.new_activity is not None:
+            self.callbacks.new_activity(self.current_activity)
+        return (True, "OK")
+
+    async def send_commands(self, commands):
+        failed = []
+        for command in commands:
+            if not await self.hub.request_async("send_command"):
+                failed.append(SimulatedSendResponse(command, 408, "Timeout"))
+            if command.delay:
+                await asyncio.sleep(command.delay)
+        return failed
+
+__all__ = ["SimulatedHarmonyAPI", "SimulatedHub", "SimulatedXmppClient", "make_config"]
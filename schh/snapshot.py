@@ -0,0 +1,95 @@
+"""Provides Snapshot for starting from what was known about the hub last time"""
+import json
+import os
+from threading import Lock
+
+# Version of the file a Snapshot is saved in
+SNAPSHOT_VERSION = 1
+
+class Snapshot:
+    """On-disk copy of the Harmony Hub's configuration, the command index
+    built from it, and what was last injected into the ASR, so the skill
+    can answer intents as soon as it starts, before the hub has been
+    reached, and needn't inject again if nothing has changed"""
+    def __init__(self, path=None):
+        """Initialize members
+
+        path: File the snapshot is loaded from and saved to, or None to
+        keep it in memory only
+        """
+        self.path = path
+        self.lock = Lock()
+        self.config = None
+        self.commands = []
+        self.voice_commands = []
+        self.injected = None
+        self.fingerprint = None
+        self.load()
+
+    def load(self):
+        """Loads the snapshot from self.path, if it exists"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as snapshot_file:
+                saved = json.load(snapshot_file)
+        except (OSError, ValueError) as e:
+            print("Failed to load snapshot from " + self.path)
+            print(e)
+            return
+        if saved.get("version") != SNAPSHOT_VERSION:
+            return
+        with self.lock:
+            self.config = saved.get("config")
+            self.commands = saved.get("commands", [])
+            self.voice_commands = saved.get("voice_commands", [])
+            injected = saved.get("injected")
+            if injected is not None:
+                injected = dict([(slot, frozenset(values)) for (slot, values) in injected.items()])
+            self.injected = injected
+            self.fingerprint = saved.get("fingerprint")
+
+    def save(self):
+        """Saves the snapshot to self.path"""
+        if self.path is None:
+            return
+        with self.lock:
+            injected = self.injected
+            if injected is not None:
+                injected = dict([(slot, sorted(values)) for (slot, values) in injected.items()])
+            saved = {
+                "version": SNAPSHOT_VERSION,
+                "config": self.config,
+                "commands": self.commands,
+                "voice_commands": self.voice_commands,
+                "injected": injected,
+                "fingerprint": self.fingerprint,
+            }
+        try:
+            with open(self.path + ".tmp", "w") as snapshot_file:
+                json.dump(saved, snapshot_file, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+        except (OSError, TypeError, ValueError) as e:
+            print("Failed to save snapshot to " + self.path)
+            print(e)
+
+    def set_config(self, config, command_index):
+        """Records a configuration downloaded from the hub and the
+        CommandIndex built from it, and saves them if they have changed"""
+        if config == self.config:
+            return
+        with self.lock:
+            self.config = config
+            self.commands = command_index.dump()
+            self.voice_commands = list(command_index.voice_commands)
+        self.save()
+
+    def set_injection(self, injected, fingerprint):
+        """Records what has been injected into the ASR, as a dict of slot
+        name to values, and saves it"""
+        with self.lock:
+            self.injected = injected
+            self.fingerprint = fingerprint
+        self.save()
+
+__all__ = ["Snapshot"]
@@ -0,0 +1,84 @@
+"""Provides StartupTimer and BackgroundStarter for starting the skill quickly"""
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from time import monotonic
+
+class StartupTimer:
+    """Records how long each phase of starting the skill takes"""
+    def __init__(self):
+        """Initialize members"""
+        self.lock = Lock()
+        self.started = monotonic()
+        self.phases = []
+        self.finished = None
+
+    @contextmanager
+    def phase(self, name):
+        """Times the body of a with statement as the named phase"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, monotonic() - start))
+
+    def finish(self):
+        """Records that starting has finished, and prints the timings"""
+        self.finished = monotonic()
+        print(self.report())
+
+    def timings(self):
+        """Returns a dict of phase name to seconds, including "total" once
+        starting has finished"""
+        with self.lock:
+            timings = dict(self.phases)
+        if self.finished is not None:
+            timings["total"] = self.finished - self.started
+        return timings
+
+    def report(self):
+        """Returns a line describing the timings"""
+        with self.lock:
+            phases = list(self.phases)
+        if self.finished is not None:
+            phases.append(("total", self.finished - self.started))
+        return "Startup: " + ", ".join(["%s %.3fs" % phase for phase in phases])
+
+class BackgroundStarter:
+    """Calls a start function on a background thread, and lets anything
+    that needs its result wait a bounded time for it"""
+    def __init__(self, start):
+        """Initialize members
+
+        start: Function to call; it returns what's being started, or None
+        if it failed
+        """
+        self.start_function = start
+        self.ready = Event()
+        self.result = None
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Starts the background thread and returns self"""
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.result = self.start_function()
+        except Exception as e:
+            print("Caught exception while starting!")
+            print(e)
+        self.ready.set()
+
+    def is_ready(self):
+        """Returns True once the start function has returned"""
+        return self.ready.is_set()
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for the start function to return;
+        returns its result, or None if it failed or is still running"""
+        self.ready.wait(timeout)
+        return self.result
+
+__all__ = ["BackgroundStarter", "StartupTimer"]
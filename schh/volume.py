@@ -0,0 +1,84 @@
+"""Provides VolumeTracker for setting a device's volume to a given level"""
+from threading import Lock
+
+from schh.scheduler import compact_label
+
+# Volume steps from silent to the loudest a device is assumed to go
+VOLUME_MAX = 50
+
+class VolumeTracker:
+    """Estimates each device's volume, in steps above silent, from the
+    volume commands sent to it.  A device's volume is unknown until it has
+    been sent enough steps down to be silent (or up to be at its loudest),
+    so the first time it's set, it's taken down to silent on the way.  The
+    estimate is only as good as the commands seen; anything else that
+    changes the volume, e.g. the device's own remote, throws it off"""
+    def __init__(self, max_level=VOLUME_MAX):
+        """Initialize members
+
+        max_level: The number of steps from silent to loudest
+        """
+        self.max_level = max_level
+        self.lock = Lock()
+        self.levels = {}
+        self.muted = {}
+
+    def get(self, device):
+        """Returns the device's volume, or None if it isn't known"""
+        return self.levels.get(str(device))
+
+    def is_muted(self, device):
+        """Returns True if the device was last muted, as far as is known"""
+        return self.muted.get(str(device), False)
+
+    def forget(self, device):
+        """Forgets the device's volume, e.g. after sends to it failed"""
+        with self.lock:
+            self.levels.pop(str(device), None)
+
+    def record_sends(self, sends, failed_devices=()):
+        """Records (device, command, count, delay) sends the hub accepted;
+        the volume of devices in failed_devices is forgotten"""
+        with self.lock:
+            for (device, command, count, _) in sends:
+                device = str(device)
+                if device in failed_devices:
+                    self.levels.pop(device, None)
+                    continue
+                label = compact_label(command)
+                if label == "mute":
+                    self.muted[device] = not self.muted.get(device, False)
+                elif label in ("volumeup", "volumedown"):
+                    self._record_steps(device, count if label == "volumeup" else -count)
+
+    def _record_steps(self, device, steps):
+        """The caller must hold self.lock"""
+        # Most devices come off mute when the volume changes
+        self.muted[device] = False
+        level = self.levels.get(device)
+        if level is None:
+            if steps >= self.max_level:
+                self.levels[device] = self.max_level
+            elif -steps >= self.max_level:
+                self.levels[device] = 0
+            return
+        self.levels[device] = max(0, min(self.max_level, level + steps))
+
+    def sends_to(self, device, level, volume_up, volume_down, delay):
+        """Returns the (device, command, count, delay) sends that take the
+        device's volume to level, given the device's commands for volume
+        up and down"""
+        level = max(0, min(self.max_level, level))
+        current = self.get(device)
+        if current is None:
+            sends = [(device, volume_down, self.max_level, delay)]
+            if level:
+                sends.append((device, volume_up, level, delay))
+            return sends
+        if level > current:
+            return [(device, volume_up, level - current, delay)]
+        if level < current:
+            return [(device, volume_down, current - level, delay)]
+        return []
+
+__all__ = ["VOLUME_MAX", "VolumeTracker"]